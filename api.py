@@ -1,22 +1,29 @@
 # Imports
 from werkzeug.utils import secure_filename
-import ged2sql
-from gedcom import parser
-import shutil
-import sqlite3
 import os
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Response, Request
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import FastAPI, HTTPException, Form, Response, Request, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.middleware.gzip import GZipMiddleware
 from config import get_cfg
 import auth
 from pydantic import EmailStr
 import sql2json
+import metrics
+import jobs
+import uploads
+import dates
 # When making changes to the auth_db directly,
 # use the same instance of the DB class,
-# this way there's only one open connection.
+# this way all requests share the same pool of connections.
 from auth import db as auth_db
 
 # Set the config for FastAPI, and read the config file into cfg dictionary
 api = FastAPI(root_path="/api")
+# Compress responses for browsers which accept gzip, except small ones where it isn't worth it.
+api.add_middleware(GZipMiddleware, minimum_size=1000)
+# Record how long each request takes, including compressing it. This is added last so it runs first.
+api.add_middleware(metrics.MetricsMiddleware)
 cfg = get_cfg()
 
 # Config-set variables
@@ -24,6 +31,17 @@ GEDCOM_DIR = f"{cfg['gedcom_dir']}"
 SESSION_TTL = cfg['session_ttl']
 TREE_NAME = cfg['tree_name']
 DB_DIR = cfg['db_dir']
+# The most people a search can return at once.
+MAX_SEARCH_RESULTS = int(cfg['max_search_results'])
+# The most people a timeline can return at once, and the events it can search for.
+MAX_TIMELINE_RESULTS = int(cfg['max_timeline_results'])
+TIMELINE_EVENTS = ('alive', 'born', 'died', 'married')
+# The most generations of ancestors or descendants a subtree can have.
+MAX_SUBTREE_GENERATIONS = int(cfg['max_subtree_generations'])
+# The largest gedcom file (in bytes) which can be uploaded, set in megabytes in the config.
+MAX_UPLOAD_SIZE = int(float(cfg['max_upload_size']) * 1024 * 1024)
+# How much bigger than the file (in bytes) an upload's request body can be, for the form's boundaries and headers.
+UPLOAD_FORM_OVERHEAD = 64 * 1024
 
 
 # Hello world test on root API (check it works)
@@ -32,11 +50,19 @@ async def root():
     return 'Hello World!'
 
 ##### GEDCOM MANAGEMENT #####
-# Take upload of gedcom file, process it, return 200 when complete.
-# If the file is not provided, return 400.
-# If there's another error, return 500 and provide the error.
+# Take upload of gedcom file, save it, then queue it to be imported in the background.
+# The file is streamed to a temporary file in GEDCOM_DIR as the request body arrives, and hashed as it is saved.
+# It only replaces the tree's gedcom file once it has been imported, so a failed, unchanged or unimportable upload
+# leaves the file the tree was last imported from as it was.
+# If too many trees are being imported at once, return 503.
+# Returns the job ID straight away, which can be polled with /upload/status/{job} to follow the import.
+# If the tree was last imported from the same file, the import is skipped, and the job is already done.
+# If the file is not provided, or the request isn't a valid form, return 400.
+# If the tree is already being imported, return 409.
+# If the file is bigger than MAX_UPLOAD_SIZE, return 413.
+# If there's an error saving the file, return 500 and provide the error.
 @api.post("/upload/gedcom")
-async def gedcom_upload(request: Request, file: UploadFile = File(...)): # Get request data, including token cookie. Require file with request.
+async def gedcom_upload(request: Request): # Get request data, including token cookie. The form is read by uploads.receive_file.
     token = request.cookies.get("token")
     # Check if cookie exists, if it doesn't respond with 401 (unauthorised) to say so.
     if not token:
@@ -46,60 +72,94 @@ async def gedcom_upload(request: Request, file: UploadFile = File(...)): # Get r
     # If validate_session returns None, then the token is either expired or invalid, so the user is not authorised.
     if username is None:
         raise HTTPException(status_code=401, detail="You are not authorised to complete this request.")
-    # If a file is not provided, exit and say so.
-    if not file.filename:
-        raise HTTPException(status_code=400, detail="File required")
-    # Extract the file extension from the file, check if it is .ged or .gedcom (supported named for GEDCOM),
-    # if it isn't, exit and say so.
-    extension = os.path.splitext(file.filename)[1].lower()
-    if extension not in {".ged", ".gedcom"}:
-        raise HTTPException(status_code=400, detail="Wrong filetype. Must be .ged/.gedcom file")
-
-    # Set the filename to remove invalid characters/spaces.
-    # Create the UPLOAD_FOLDER if it doesn't exist
-    filename = secure_filename(file.filename)
-    os.makedirs(GEDCOM_DIR, exist_ok=True)
-    file_path = os.path.join(GEDCOM_DIR, filename)
-    # Save the uploaded file to file_path (UPLOAD_FOLDER joined with filename), report error if an error occurs.
+    # If the request says it is too big, reject it before reading any of it.
+    # The body also holds the form's boundaries and headers, so it is allowed to be a little bigger than the file.
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + UPLOAD_FORM_OVERHEAD:
+        raise HTTPException(status_code=413, detail=f"File too large. The maximum size is {MAX_UPLOAD_SIZE} bytes")
+
+    job_id = None
+    tree_name = None
+    gedcom_path = None
+    # Called once the file's headers have been read, before any of the file is saved.
+    # Returns the temporary path to save the file to, next to the gedcom file it will replace.
+    def start_upload(filename):
+        nonlocal job_id, tree_name, gedcom_path
+        # Extract the file extension from the file, check if it is .ged or .gedcom (supported named for GEDCOM),
+        # if it isn't, exit and say so.
+        extension = os.path.splitext(filename)[1].lower()
+        if extension not in {".ged", ".gedcom"}:
+            raise HTTPException(status_code=400, detail="Wrong filetype. Must be .ged/.gedcom file")
+        # Set the filename to remove invalid characters/spaces.
+        # Extract the tree name from the filename (filename without extension),
+        # and create a job for it. Only one import of each tree can run at a time.
+        filename = secure_filename(filename)
+        tree_name = os.path.splitext(filename)[0]
+        job_id = jobs.create_job(username, tree_name)
+        if job_id is None:
+            raise HTTPException(status_code=409, detail="This tree is already being imported. Please wait for it to finish.")
+        # Create the UPLOAD_FOLDER if it doesn't exist
+        os.makedirs(GEDCOM_DIR, exist_ok=True)
+        gedcom_path = os.path.join(GEDCOM_DIR, filename)
+        return os.path.join(GEDCOM_DIR, f".{filename}.{job_id}.upload")
+
+    # Mark the job (if it has been created) as failed, and respond with the error.
+    def fail_upload(status_code, detail):
+        if job_id is not None:
+            jobs.finish_job(job_id, "failed", detail)
+        raise HTTPException(status_code=status_code, detail=detail)
+
+    # Save the uploaded file to UPLOAD_FOLDER joined with filename, report error if an error occurs.
+    # If saving fails, the part of the file which was saved is deleted by receive_file.
     try:
-        with open(file_path, "wb") as savefile:
-            shutil.copyfileobj(file.file, savefile)
+        upload = await uploads.receive_file(request, "file", MAX_UPLOAD_SIZE, start_upload)
+    except HTTPException:
+        raise
+    except uploads.UploadTooLarge as e:
+        fail_upload(413, f"File too large. {e}")
+    except uploads.UploadMalformed as e:
+        fail_upload(400, str(e))
     except Exception as e:
-        if os.path.exists(file_path):
-            os.remove(file_path)
         print(f'Error when saving file: {e}')
-        raise HTTPException(status_code=500, detail=f"Error when saving file: {e}")
+        fail_upload(500, f"Error when saving file: {e}")
+    # If a file is not provided, exit and say so.
+    if upload is None:
+        fail_upload(400, "File required")
 
-    # Attempt to parse gedcom file using ged2sql
-    # Extract the tree name from the file path (filename without extension), then add this to the user's trees.
-    try:
-        ged2sql.run(file_path)
-        tree_name = os.path.splitext(filename)[0]
+    # If the tree was last imported from a byte-identical file, importing it again would change nothing, so it is skipped.
+    # The tree is still added to the user's trees, in case it was imported by someone else.
+    if jobs.already_imported(tree_name, upload["sha256"]):
+        os.remove(upload["path"])
         auth_db.add_tree_to_user(username, tree_name)
-    # Some known errors are handled and different responses are sent.
-    # If the error is unknown, the entire error message is output and the process stops.
-    except sqlite3.DatabaseError as e:
-        message = f'Database file is corrupted. Please delete/move it and try again. {e}'
-        print(f"SQL.DatabaseError: {e}")
-        os.remove(GEDCOM_DIR + "/" + filename)
-        raise HTTPException(status_code=500, detail=message)
-    except (parser.GedcomFormatViolationError, AttributeError) as e:
-        message = f'Gedcom Parse failed. Is this a valid Gedcom file? {e}'
-        print(f"GedcomFormatViolationError: {e}")
-        os.remove(GEDCOM_DIR + "/" + filename)
-        raise HTTPException(status_code=500, detail=message)
-    except UnicodeDecodeError as e:
-        message = f'The file is not a readable format. Please re-generate the file or try a different file. {e}'
-        print(f'UnicodeDecodeError: {e}')
-        os.remove(GEDCOM_DIR + "/" + filename)
-        raise HTTPException(status_code=500, detail=message)
-    except Exception as e:
-        message = f'An unexpected error occurred: {str(e)}'
-        print(f"Unexpected Error: {e}")
-        os.remove(GEDCOM_DIR + "/" + filename)
-        raise HTTPException(status_code=500, detail=message)
-    # If no errors are reported, return 200 ok.
-    return {"status": "ok"}
+        jobs.finish_job(job_id, "done")
+        return {"status": "unchanged", "job": job_id}
+
+    # Queue the import to be parsed by ged2sql in the background, which adds the tree to the user's trees when it is done.
+    # The old version of the tree (and its cached JSON and gedcom file) is still served until the new version has been imported.
+    try:
+        jobs.start_import(job_id, upload["path"], gedcom_path, upload["sha256"])
+    except jobs.TooManyImports:
+        os.remove(upload["path"])
+        fail_upload(503, "Too many trees are being imported at the moment. Please try again later.")
+    return {"status": "queued", "job": job_id}
+
+# Get the status of an import job: its phase (saving, queued, parsing, comparing, loading, indexing, done or failed),
+# the number of records processed so far, the throughput in records per second, and the error if it failed.
+# Users can only see their own jobs, anyone else's return 404.
+@api.get("/upload/status/{job}")
+async def upload_status(request: Request, job: str):
+    # Get session token from cookie, if it does not exist then state there must be a valid session token.
+    token = request.cookies.get("token")
+    if not token:
+        raise HTTPException(status_code=401, detail="You must provide a valid session token")
+    # Check the token is valid, if validate_session returns None, it is invalid, so return 401 Unauthorised.
+    username = auth.validate_session(token)
+    if username is None:
+        raise HTTPException(status_code=401, detail="You are not authorised to complete this request")
+    status = jobs.get_job(job, username)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found.")
+    return status
 
 ##### USER MANAGEMENT #####
 
@@ -107,7 +167,8 @@ async def gedcom_upload(request: Request, file: UploadFile = File(...)): # Get r
 @api.post('/login/create')
 async def create_user(response: Response, username: str = Form(...), email: EmailStr = Form(...), password: str = Form(...)):
         # Send to auth to create the user, if the result is 200, then it was successful
-        result = auth.create_user(username, email, password)
+        # The password is hashed off the event loop, so other requests carry on while this waits.
+        result = await auth.create_user(username, email, password)
         if result == 200:
             # If result was successful, call to create a session with that username,
             # then set a cookie with the details of the token
@@ -139,7 +200,8 @@ async def verify_user(response: Response, username: str = Form(...), password: s
     if not username or not password:
         raise HTTPException(status_code=401, detail="You must provide a username and password")
     # Send username and password to auth.verify_user to check, result is either 200 or 401... Why haven't I done a boolean for these???
-    result = auth.verify_user(username, password)
+    # The hash is checked off the event loop, so other requests carry on while this waits.
+    result = await auth.verify_user(username, password)
     # If result is 401, details are wrong, so say username or password incorrect.
     if not result:
         raise HTTPException(status_code=403, detail= "Username or Password incorrect")
@@ -200,8 +262,9 @@ async def delete_session(request: Request):
 ##### TREE ROUTES #####
 
 # Gets the json for the given tree from SQL, if an error is encountered, return it.
+# format can be 'json' for a list of people, or 'columnar' for the smaller columnar format described in sql2json.
 @api.get('/tree')
-async def get_tree(request: Request, tree: str):
+async def get_tree(request: Request, tree: str, format: str = "json"):
     # Get session token from cookie, if it does not exist then state there must be a valid session token.
     token = request.cookies.get("token")
     if not token:
@@ -210,23 +273,164 @@ async def get_tree(request: Request, tree: str):
     username = auth.validate_session(token)
     if username is None:
         raise HTTPException(status_code=401, detail="You are not authorised to complete this request")
+    if format not in sql2json.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(sql2json.FORMATS)}")
 
     # Check the user has access to the tree they ask for.
     if auth.check_tree_match(username, tree):
-        # Try to convert the data from SQL to JSON, if there's an error return 500 with the error.
+        # Try to get the cached JSON for the tree, if there's an error return 500 with the error.
         try:
-            output = sql2json.run(tree)
+            cache_path = sql2json.get_cache(tree, format)
+            # If the cache has not been built yet, stream the tree straight from its DB while building the cache.
+            # The response is compressed on the fly by the GZipMiddleware.
+            if cache_path is None:
+                stream = sql2json.stream_cache(tree, format)
+                # If the tree's database file is not found, return 404 Not Found
+                if stream is None:
+                    raise HTTPException(status_code=404, detail="Tree not found.")
+                return StreamingResponse(stream, media_type="application/json", headers={"Cache-Control": "private, no-cache"})
+        except HTTPException:
+            raise
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
-        # If output does not find the file, return 404 Not Found
-        if output == None:
-            raise HTTPException(status_code=404, detail="Tree not found.")
-        # Return the output from sql2json (JSON data)
-        return output
+
+        # The ETag and Last-Modified headers come from the cache file, which only changes when the tree is re-uploaded.
+        # Browsers which accept gzip are sent the gzipped copy of the cache, which has its own ETag.
+        stat = os.stat(cache_path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        headers = {
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "Cache-Control": "private, no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        gzip_path = sql2json.gzip_cache_path(tree, format)
+        if "gzip" in request.headers.get("accept-encoding", "") and os.path.isfile(gzip_path):
+            cache_path = gzip_path
+            etag = etag[:-1] + '-gzip"'
+            headers["Content-Encoding"] = "gzip"
+        headers["ETag"] = etag
+
+        # If the browser already has this version, return 304 Not Modified without sending the tree again.
+        if not_modified(request, etag, stat.st_mtime):
+            headers.pop("Content-Encoding", None)
+            return Response(status_code=304, headers=headers)
+
+        # Send the stored JSON bytes from the file in chunks, so they don't need to be encoded again
+        # or read into memory all at once.
+        return FileResponse(cache_path, media_type="application/json", headers=headers)
     # If auth.check_tree_match does not return True, state Tree not found.
     else:
         raise HTTPException(status_code=404, detail="Tree not found.")
 
+# Gets the json for part of the given tree, centred on one person (focus),
+# with up to {ancestors} generations above them and {descendants} generations below them.
+# Both must be between 0 and MAX_SUBTREE_GENERATIONS, otherwise FastAPI responds with 422.
+# This lets the website show a large tree a piece at a time, rather than loading every person at once.
+@api.get('/tree/subtree')
+async def get_subtree(request: Request, tree: str, focus: str,
+                      ancestors: int = Query(3, ge=0, le=MAX_SUBTREE_GENERATIONS),
+                      descendants: int = Query(3, ge=0, le=MAX_SUBTREE_GENERATIONS)):
+    # Get session token from cookie, if it does not exist then state there must be a valid session token.
+    token = request.cookies.get("token")
+    if not token:
+        raise HTTPException(status_code=401, detail="You must provide a valid session token")
+    # Check the token is valid, store in username variable. If validate_session returns None, it is invalid, so return 401 Unauthorised.
+    username = auth.validate_session(token)
+    if username is None:
+        raise HTTPException(status_code=401, detail="You are not authorised to complete this request")
+    # Check the user has access to the tree they ask for, if not state Tree not found.
+    if not auth.check_tree_match(username, tree):
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    # Try to get the subtree from SQL, if there's an error return 500 with the error.
+    try:
+        output = sql2json.run_subtree(tree, focus, ancestors, descendants)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    # If the tree is not found return 404, and if the focus person is not found (empty list) return 404 too.
+    if output == None:
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    if len(output) == 0:
+        raise HTTPException(status_code=404, detail="Person not found.")
+    # Encode the output to bytes directly, rather than through FastAPI's generic encoder.
+    return Response(content=sql2json.encode_json(output), media_type="application/json")
+
+# Searches the given tree for people whose names, places or occupation start with the words in q, e.g. 'jo smi' finds John Smith.
+# Returns up to {limit} people, best matches first. Their IDs can be used as the focus of /tree/subtree.
+@api.get('/tree/search')
+async def search_tree(request: Request, tree: str, q: str, limit: int = 20):
+    # Get session token from cookie, if it does not exist then state there must be a valid session token.
+    token = request.cookies.get("token")
+    if not token:
+        raise HTTPException(status_code=401, detail="You must provide a valid session token")
+    # Check the token is valid, store in username variable. If validate_session returns None, it is invalid, so return 401 Unauthorised.
+    username = auth.validate_session(token)
+    if username is None:
+        raise HTTPException(status_code=401, detail="You are not authorised to complete this request")
+    if limit < 1 or limit > MAX_SEARCH_RESULTS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_SEARCH_RESULTS}")
+
+    # Check the user has access to the tree they ask for, if not state Tree not found.
+    if not auth.check_tree_match(username, tree):
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    # Try to search the tree, if there's an error return 500 with the error.
+    try:
+        output = sql2json.run_search(tree, q, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    if output == None:
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    return Response(content=sql2json.encode_json(output), media_type="application/json")
+
+# Find the people in a tree who were born, died, married or alive (the event) between start and end, sorted by birth date.
+# start and end are gedcom dates, e.g. 1850, MAR 1850 or 3 MAR 1850, and the search runs from the start of start to the end of end.
+# Dates in the tree are matched by the range they were parsed into at import, so e.g. ABT 1850 is found by a search for 1853.
+@api.get('/tree/timeline')
+async def tree_timeline(request: Request, tree: str, start: str, end: str, event: str = "alive", limit: int = 100):
+    # Get session token from cookie, if it does not exist then state there must be a valid session token.
+    token = request.cookies.get("token")
+    if not token:
+        raise HTTPException(status_code=401, detail="You must provide a valid session token")
+    # Check the token is valid, store in username variable. If validate_session returns None, it is invalid, so return 401 Unauthorised.
+    username = auth.validate_session(token)
+    if username is None:
+        raise HTTPException(status_code=401, detail="You are not authorised to complete this request")
+    if event not in TIMELINE_EVENTS:
+        raise HTTPException(status_code=400, detail=f"event must be one of {', '.join(TIMELINE_EVENTS)}")
+    if limit < 1 or limit > MAX_TIMELINE_RESULTS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_TIMELINE_RESULTS}")
+    start_day = dates.parse_date(start)[0]
+    end_day = dates.parse_date(end)[1]
+    if start_day is None or end_day is None:
+        raise HTTPException(status_code=400, detail="start and end must be dates, e.g. 1850, MAR 1850 or 3 MAR 1850")
+    if start_day > end_day:
+        raise HTTPException(status_code=400, detail="start must not be after end")
+
+    # Check the user has access to the tree they ask for, if not state Tree not found.
+    if not auth.check_tree_match(username, tree):
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    # Try to get the timeline, if there's an error return 500 with the error.
+    try:
+        output = sql2json.run_timeline(tree, event, start_day, end_day, limit)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    if output == None:
+        raise HTTPException(status_code=404, detail="Tree not found.")
+    return Response(content=sql2json.encode_json(output), media_type="application/json")
+
+# Checks the conditional headers of a request against the ETag and modification time of a response.
+# Returns True if the browser's copy is still up to date. If-None-Match is used if it is sent, otherwise If-Modified-Since is.
+def not_modified(request, etag, modified):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 # Deletes the SQL and Gedcom file for the given tree, and removes it from the auth DB.
 @api.delete('/tree/delete')
 async def delete_tree(request: Request, tree: str):
@@ -239,12 +443,17 @@ async def delete_tree(request: Request, tree: str):
     if username is None:
         raise HTTPException(status_code=401, detail="You not authorised to complete this request")
     # If the token is valid, call auth_db.delete_user_tree for the username and tree then delete the DB and gedcom file.
+    # The gedcom file can end in .ged or .gedcom, and any of the files may already be missing, which isn't an error.
     try:
         auth_db.delete_user_tree(username, tree)
+        sql2json.invalidate_cache(tree)
+        sql2json.close_tree_db(tree)
         tree_path = f"{DB_DIR}/{tree}.db"
-        ged_path = f"{GEDCOM_DIR}/{tree}.ged"
-        os.remove(tree_path)
-        os.remove(ged_path)
+        for path in (tree_path, f"{GEDCOM_DIR}/{tree}.ged", f"{GEDCOM_DIR}/{tree}.gedcom"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
     # If there's an error with deleting, return 500 and state the error.
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
@@ -276,4 +485,19 @@ async def get_ttl():
 # Retrieve tree_name, used for the home page to display the tree name.
 @api.get('/config/name')
 async def get_name():
-    return {'name': TREE_NAME}
\ No newline at end of file
+    return {'name': TREE_NAME}
+
+##### METRICS #####
+# Gauges for the state of the pools and caches, read each time the metrics are shown.
+metrics.Gauge('hash_pool_queued', 'Password hashing jobs waiting for a thread in the hash pool.', lambda: auth.get_hash_stats()["queued"])
+metrics.Gauge('hash_pool_running', 'Password hashing jobs running in the hash pool.', lambda: auth.get_hash_stats()["running"])
+metrics.Gauge('imports_active', 'Trees which are being imported by any worker.', jobs.db.count_running_jobs)
+metrics.Gauge('session_cache_entries', 'Sessions held in the session cache.', lambda: len(auth.session_cache))
+metrics.Gauge('tree_dbs_open', 'Tree databases which are open.', lambda: len(sql2json.tree_dbs))
+
+# Show request latencies, stage timings, SQL query counts and durations, and the gauges above, in Prometheus' text format.
+# This doesn't need a session, so that Prometheus can scrape it.
+# When the API runs as several worker processes, each request is answered by one worker with its own metrics.
+@api.get('/metrics')
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
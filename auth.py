@@ -2,8 +2,13 @@ import sqlite3
 from passlib.hash import argon2
 from database import Database
 from config import get_cfg
+import metrics
 from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import secrets
+import threading
+import time
 import os
 import re
 
@@ -11,21 +16,111 @@ import re
 cfg = get_cfg()
 SESSION_TTL = timedelta(hours=(float(cfg['session_ttl'])))
 USER_DIR = str(cfg['user_data_dir'])
+# How long (in seconds) a session is trusted from the cache before it is checked against the DB again,
+# and how often (in seconds) expired sessions are swept out of the cache and the DB.
+SESSION_CACHE_TTL = float(cfg['session_cache_ttl'])
+SESSION_SWEEP_INTERVAL = float(cfg['session_sweep_interval'])
+# The most often (in seconds) the auth DB is checked for sessions revoked by another API worker process.
+REVOCATION_CHECK_INTERVAL = float(cfg['revocation_check_interval'])
+# Argon2 cost parameters: time_cost is the number of iterations, memory_cost is in KiB,
+# and parallelism is the number of lanes. Higher values are more secure but make logins slower.
+ARGON2_TIME_COST = int(cfg['argon2_time_cost'])
+ARGON2_MEMORY_COST = int(cfg['argon2_memory_cost'])
+ARGON2_PARALLELISM = int(cfg['argon2_parallelism'])
+# The most password hashes/verifications which can run at once, any more wait in the pool's queue.
+HASH_WORKERS = int(cfg['hash_workers'])
+# The number of read-only connections kept open to the auth DB.
+AUTH_DB_READERS = int(cfg['auth_db_readers'])
 
-# Create User directory, connect to/create database, and create the Auth DB tables (if they don't exist).
+# Create User directory and connect to/create database. The tables are created by setup().
+# The auth DB is used by the API, the session sweeper and import jobs at the same time,
+# so it is opened in WAL mode with a pool of read connections.
 os.makedirs(USER_DIR, exist_ok=True)
-db = Database(f'{USER_DIR}/auth.db')
-db.create_auth_db()
-db.clear_sessions() # Clear open sessions when program restarts, logging out all users.
+db = Database(f'{USER_DIR}/auth.db', readers=AUTH_DB_READERS, wal=True, name='auth')
+
+# In-memory cache of sessions, so that validating a session doesn't need a DB query on every request.
+# Maps each token to (username, expires_at, cached_until), where cached_until is a time.monotonic() value.
+# The lock is needed because the sweeper thread changes the cache too.
+# revocation_count is the auth DB's revocation count when the cache was last checked, and next_revocation_check
+# is the time.monotonic() value after which it is checked again (see check_session_cache).
+session_cache = {}
+session_cache_lock = threading.Lock()
+revocation_count = None
+next_revocation_check = 0
+
+# Argon2 hasher using the configured cost parameters.
+# Existing hashes store the parameters they were made with, so they can still be verified if the config changes.
+hasher = argon2.using(time_cost=ARGON2_TIME_COST, memory_cost=ARGON2_MEMORY_COST, parallelism=ARGON2_PARALLELISM)
+
+# Hashing a password takes tens of milliseconds, which would block every other request if it ran on the event loop.
+# Instead it runs in this pool of threads (argon2 releases the GIL while it works).
+# hash_stats counts the jobs which are waiting in the queue and running, so the queue depth can be reported.
+hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="argon2")
+hash_stats = {"queued": 0, "running": 0}
+hash_stats_lock = threading.Lock()
+
+# Create the Auth DB tables (if they don't exist), and clear open sessions, logging out all users.
+# This runs once when the server starts (from main.py), not when each API worker imports this module,
+# otherwise every worker that started would log everyone out.
+def setup():
+    db.create_auth_db()
+    db.clear_sessions()
+
+##### PASSWORD HASHING #####
+# Runs a function in the hash pool, keeping hash_stats up to date, and waits for the result without blocking the event loop.
+# state records whether the job has started on a pool thread, so each job is counted as exactly one of queued or running.
+# If the request is cancelled (e.g. the client disconnects) while the job is still queued, it is taken out of the queued count
+# and won't run. A job which has started is taken out of the running count by its pool thread once the function returns,
+# rather than here, as it keeps running even if the request is cancelled.
+async def run_in_hash_pool(function, *args):
+    state = {"started": False, "abandoned": False}
+    with hash_stats_lock:
+        hash_stats["queued"] += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, run_counted, state, function, *args)
+    finally:
+        with hash_stats_lock:
+            if not state["started"]:
+                state["abandoned"] = True
+                hash_stats["queued"] -= 1
+
+# Called on a pool thread when a job starts, moving it from queued to running before calling the function,
+# and out of running once it returns. Jobs whose request has already given up on them aren't run.
+def run_counted(state, function, *args):
+    with hash_stats_lock:
+        if state["abandoned"]:
+            return None
+        state["started"] = True
+        hash_stats["queued"] -= 1
+        hash_stats["running"] += 1
+    try:
+        return function(*args)
+    finally:
+        with hash_stats_lock:
+            hash_stats["running"] -= 1
+
+# Returns a copy of hash_stats: how many hashes are waiting for a thread, and how many are running.
+def get_hash_stats():
+    with hash_stats_lock:
+        return dict(hash_stats)
+
+# Hash a password in the hash pool.
+async def hash_password(password):
+    return await run_in_hash_pool(hasher.hash, password)
+
+# Check a password against a hash in the hash pool.
+async def check_password(password, pass_hash):
+    return await run_in_hash_pool(hasher.verify, password, pass_hash)
 
 ##### USER MANAGEMENT #####
 # Take user details, hash the password, create a new user entry with details in DB.
 # If there's any errors, respond with the error, else return true.
-def create_user(username, email, password):
+# The password is hashed in the hash pool, so this must be awaited.
+async def create_user(username, email, password):
     # Check password with check_strength, if it returns false then return 400 to API.
     if not check_strength(password):
         return 400
-    pass_hash = argon2.hash(password)
+    pass_hash = await hash_password(password)
     try:
         db.new_user(username, email, pass_hash)
     except sqlite3.IntegrityError:
@@ -56,11 +151,11 @@ def check_strength(password):
     return True
 
 # Take username and password, retrieve the hash from that username.
-# Check password against hash, if it's valid respond with 200(ok), else return 401 (unauthorised)
-def verify_user(username, password):
+# Check password against hash (in the hash pool, so this must be awaited), if it's valid return True, else return False
+async def verify_user(username, password):
     pass_hash = db.verify_user(username)
     if pass_hash:
-        if argon2.verify(password, pass_hash):
+        if await check_password(password, pass_hash):
             return True
         else:
             return False
@@ -76,6 +171,11 @@ def delete_user(token):
     else:
         revoke_session(token)
         db.delete_user(username)
+        # Deleting the user deletes all of their sessions from the DB, so remove any of them that are cached too.
+        with session_cache_lock:
+            for cached_token, cached in list(session_cache.items()):
+                if cached[0] == username:
+                    del session_cache[cached_token]
     return True
 
 # Take a username and tree, get a user's list of trees from DB.
@@ -88,28 +188,88 @@ def check_tree_match(username, tree):
         return False
 
 ##### SESSION MANAGEMENT #####
-# Get the session for that token from DB, if it doesn't exist, return 401 (unauthorised).
+# Get the session for that token, from the cache if it was cached recently, otherwise from the DB.
+# If it doesn't exist, return None (unauthorised).
 # If it does exist, check the time is in the future (not expired).
-# If it is expired, delete the session token, if it is valid, return 200 (ok)
+# If it is expired, delete the session token and return None, if it is valid, return the username.
+@metrics.timed('auth.validate_session')
 def validate_session(token):
-    row = db.get_session(token)
-    if not row:
-        return None
-    token, username, expires_at = row
-    if datetime.fromisoformat(expires_at) < datetime.now(timezone.utc):
-        revoke_session(token)
+    check_session_cache()
+    with session_cache_lock:
+        cached = session_cache.get(token)
+    if cached and cached[2] > time.monotonic():
+        username, expires_at, cached_until = cached
+    else:
+        row = db.get_session(token)
+        if not row:
+            with session_cache_lock:
+                session_cache.pop(token, None)
+            return None
+        token, username, expires_at = row
+        expires_at = datetime.fromisoformat(expires_at)
+        cache_session(token, username, expires_at)
+    # Every cache checks the expiry time itself, so deleting an expired session doesn't count as revoking it.
+    if expires_at < datetime.now(timezone.utc):
+        db.delete_session(token, revoked=False)
+        with session_cache_lock:
+            session_cache.pop(token, None)
         return None
     return username
 
-# Delete the session from that token
+# When the API runs as several worker processes, each has its own session cache,
+# so a session revoked by one worker (by logging out or deleting the user) could still be trusted from another worker's cache.
+# Revoking a session adds one to the auth DB's revocation count, so when the count changes, the whole cache is cleared
+# and sessions are read from the DB again. The count is read at most once every REVOCATION_CHECK_INTERVAL seconds,
+# and other changes to the auth DB (e.g. new sessions) don't clear the cache, which otherwise relies on SESSION_CACHE_TTL.
+def check_session_cache():
+    global revocation_count, next_revocation_check
+    now = time.monotonic()
+    if now < next_revocation_check:
+        return
+    next_revocation_check = now + REVOCATION_CHECK_INTERVAL
+    count = db.get_revocation_count()
+    with session_cache_lock:
+        if count != revocation_count:
+            session_cache.clear()
+            revocation_count = count
+
+# Add a session to the cache, trusting it for SESSION_CACHE_TTL seconds.
+def cache_session(token, username, expires_at):
+    with session_cache_lock:
+        session_cache[token] = (username, expires_at, time.monotonic() + SESSION_CACHE_TTL)
+
+# Delete the session from that token, from both the DB and the cache.
 def revoke_session(token):
     db.delete_session(token)
+    with session_cache_lock:
+        session_cache.pop(token, None)
 
 # Take the username, generate a 32 byte token, take the current time,
 # add the time from SESSION_TTL (config for session time, in hours),
-# then create that session in the DB.
+# then create that session in the DB and the cache.
 def create_session(username):
     token = secrets.token_urlsafe(32)
     expires_at = datetime.now(timezone.utc) + SESSION_TTL
     db.save_session(username, token, expires_at)
-    return token, expires_at
\ No newline at end of file
+    cache_session(token, username, expires_at)
+    return token, expires_at
+
+# Runs in a background thread, removing expired sessions every SESSION_SWEEP_INTERVAL seconds.
+# Sessions which have expired, or have been in the cache longer than SESSION_CACHE_TTL, are removed from the cache,
+# and expired sessions are deleted from the DB, rather than waiting until they are used or the server restarts.
+def sweep_sessions():
+    while True:
+        time.sleep(SESSION_SWEEP_INTERVAL)
+        try:
+            now = datetime.now(timezone.utc)
+            monotonic_now = time.monotonic()
+            with session_cache_lock:
+                for token, (username, expires_at, cached_until) in list(session_cache.items()):
+                    if expires_at < now or cached_until < monotonic_now:
+                        del session_cache[token]
+            db.delete_expired_sessions(now)
+        except Exception as e:
+            print(f'Error when sweeping expired sessions: {e}')
+
+# Start the sweeper as a daemon thread, so it stops when the program does.
+threading.Thread(target=sweep_sessions, name="session-sweeper", daemon=True).start()
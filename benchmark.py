@@ -0,0 +1,364 @@
+import subprocess
+import argparse
+import platform
+import tempfile
+import random
+import shutil
+import gc
+import json
+import time
+import sys
+import os
+
+# Benchmarks for the import and render pipeline. There are two benchmarks:
+# - pipeline: generates a synthetic gedcom file, then times each stage of importing it and serving it
+#   (parse_file, parse_chunks, add_data, indexing, get_individuals_data, jsonify, remove_isolated_individuals, encoding, and /api/tree).
+# - encode: compares the ways a tree's JSON can be encoded, on synthetic trees of different sizes.
+# Each run is appended as one line of JSON to the results file (benchmark_results.jsonl by default),
+# along with the git commit it was run on, so results can be compared between commits.
+# Run with e.g.
+#   python benchmark.py pipeline --generations 8 --branching 3
+#   python benchmark.py encode --sizes 10000 100000 1000000
+#   python benchmark.py generate --generations 6 tree.ged
+#
+# Importing the app's modules creates config.ini and user data in the working directory,
+# so they are only imported once the benchmark has moved into a temporary directory.
+
+ENCODE_SIZES = [10000, 100000, 1000000]
+RESULTS_FILE = "benchmark_results.jsonl"
+
+##### SYNTHETIC GEDCOM #####
+FIRST_NAMES = {
+    "M": ["John", "William", "Thomas", "James", "George", "Henry", "Charles", "Joseph", "Edward", "Robert"],
+    "F": ["Mary", "Elizabeth", "Sarah", "Ann", "Jane", "Margaret", "Emma", "Alice", "Martha", "Hannah"],
+}
+SURNAMES = [f"Surname{n}" for n in range(2000)]
+PLACES = [f"Town{n}, County{n % 40}" for n in range(1000)]
+OCCUPATIONS = ["Farmer", "Labourer", "Weaver", "Clerk", "Teacher", "Miner", "Servant", "Blacksmith", "Carpenter"]
+DATE_QUALIFIERS = ["", "", "", "ABT ", "BEF ", "AFT ", "EST "]
+MONTHS = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+
+# Writes a synthetic gedcom file to path, and returns the number of people and families in it.
+# The tree starts with {founders} couples, and each generation's children become the next generation:
+# - each person marries with probability {marriage}, to a new person who has no parents in the tree
+# - each married person marries a second time with probability {remarriage}
+# - each marriage has between 0 and 2 * {branching} children, so {branching} on average
+# - each family leaves out its husband or wife with probability {missing_parents}
+# The same arguments always give the same file, as everything random comes from one seeded generator.
+def generate_gedcom(path, generations=6, branching=2.0, founders=10, marriage=0.8, remarriage=0.1, missing_parents=0.05, seed=0):
+    rng = random.Random(seed)
+    people = 0
+    families = 0
+    with open(path, "w", encoding="utf-8", newline="\n") as gedcom_file:
+        gedcom_file.write("0 HEAD\n1 SOUR benchmark.py\n1 GEDC\n2 VERS 5.5.1\n1 CHAR UTF-8\n")
+
+        # Write a person and return their ID. Born in the given year, give or take a few years.
+        def add_person(sex, surname, year):
+            nonlocal people
+            people += 1
+            lines = [
+                f"0 @I{people}@ INDI",
+                f"1 NAME {rng.choice(FIRST_NAMES[sex])} /{surname}/",
+                f"1 SEX {sex}",
+                "1 BIRT",
+                f"2 DATE {random_date(rng, year + rng.randint(-5, 5))}",
+                f"2 PLAC {rng.choice(PLACES)}",
+            ]
+            if rng.random() < 0.6:
+                lines += ["1 DEAT", f"2 DATE {random_date(rng, year + rng.randint(30, 90))}", f"2 PLAC {rng.choice(PLACES)}"]
+            if rng.random() < 0.4:
+                lines.append(f"1 OCCU {rng.choice(OCCUPATIONS)}")
+            gedcom_file.write("\n".join(lines) + "\n")
+            return people
+
+        # Write a family, and return its children as (id, sex, surname) for the next generation.
+        def add_family(husband, wife, surname, year):
+            nonlocal families
+            families += 1
+            family = families
+            children = []
+            for _ in range(rng.randint(0, round(2 * branching))):
+                sex = rng.choice("MF")
+                children.append((add_person(sex, surname, year + rng.randint(20, 40)), sex, surname))
+            lines = [f"0 @F{family}@ FAM"]
+            # Sometimes a parent is unknown, so one of them is left out of the family.
+            missing = None
+            if rng.random() < missing_parents:
+                missing = rng.choice(["HUSB", "WIFE"])
+            if missing != "HUSB":
+                lines.append(f"1 HUSB @I{husband}@")
+            if missing != "WIFE":
+                lines.append(f"1 WIFE @I{wife}@")
+            for child, _, _ in children:
+                lines.append(f"1 CHIL @I{child}@")
+            if rng.random() < 0.7:
+                lines += ["1 MARR", f"2 DATE {random_date(rng, year + rng.randint(18, 30))}", f"2 PLAC {rng.choice(PLACES)}"]
+            gedcom_file.write("\n".join(lines) + "\n")
+            return children
+
+        year = 1500
+        generation = []
+        for _ in range(founders):
+            surname = rng.choice(SURNAMES)
+            generation.append((add_person("M", surname, year), "M", surname))
+            generation.append((add_person("F", rng.choice(SURNAMES), year), "F", surname))
+
+        for _ in range(generations):
+            next_generation = []
+            for person, sex, surname in generation:
+                marriages = 0
+                if rng.random() < marriage:
+                    marriages = 2 if rng.random() < remarriage else 1
+                for _ in range(marriages):
+                    # The children take the husband's surname.
+                    if sex == "M":
+                        partner = add_person("F", rng.choice(SURNAMES), year)
+                        next_generation += add_family(person, partner, surname, year)
+                    else:
+                        partner_surname = rng.choice(SURNAMES)
+                        partner = add_person("M", partner_surname, year)
+                        next_generation += add_family(partner, person, partner_surname, year)
+            generation = next_generation
+            year += 30
+
+        gedcom_file.write("0 TRLR\n")
+    return people, families
+
+# Make a random gedcom date around the given year, e.g. '12 MAR 1850', 'ABT 1850' or 'BET 1848 AND 1852'.
+def random_date(rng, year):
+    kind = rng.random()
+    if kind < 0.5:
+        return f"{rng.randint(1, 28)} {rng.choice(MONTHS)} {year}"
+    if kind < 0.9:
+        return f"{rng.choice(DATE_QUALIFIERS)}{year}"
+    return f"BET {year - 2} AND {year + 2}"
+
+##### TIMING #####
+# Time a function, returning its result and the time it took in seconds.
+# Garbage is collected first, so that a collection caused by an earlier stage isn't counted against this one.
+def timed(function, *args, **kwargs):
+    gc.collect()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+# Get the highest memory use of this process so far in MB, or None if it can't be found on this platform.
+def peak_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere.
+    if sys.platform == "darwin":
+        return round(peak / 1e6, 1)
+    return round(peak / 1e3, 1)
+
+# Get the commit the benchmark is being run on, so results can be compared between commits.
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+# Append one run's results to the results file as a line of JSON.
+def save_results(results_path, benchmark, parameters, results):
+    run = {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": parameters,
+        "results": results,
+    }
+    with open(results_path, "a") as results_file:
+        results_file.write(json.dumps(run) + "\n")
+    print(f"Results saved to {results_path}")
+
+##### PIPELINE BENCHMARK #####
+# Generate a synthetic gedcom file, then time each stage of importing it and serving it.
+# Everything is run inside work_dir, which holds the config, user data and tree DBs for the benchmark.
+def run_pipeline(args, work_dir):
+    gedcom_path = os.path.join(work_dir, "benchmark.ged")
+    (people, families), generate_time = timed(generate_gedcom, gedcom_path, args.generations, args.branching,
+                                              args.founders, args.marriage, args.remarriage, args.missing_parents, args.seed)
+    print(f"Generated {people} people and {families} families ({os.path.getsize(gedcom_path) / 1e6:.1f}MB) in {generate_time:.2f}s")
+
+    os.chdir(work_dir)
+    from fastapi.testclient import TestClient
+    from database import Database
+    import ged2sql
+    import sql2json
+    import auth
+    import jobs
+    import api
+    auth.setup()
+    jobs.setup()
+
+    results = {"people": people, "families": families}
+    stages = {}
+
+    # parse_file is a generator, so the elements are collected into a list to time parsing on its own.
+    elements, stages["parse_file"] = timed(lambda: list(ged2sql.parse_file(gedcom_path)))
+    # Parsing in worker processes, as large imports do, including the time to start the workers.
+    workers = ged2sql.PARSE_WORKERS
+    results["parse_workers"] = workers
+    _, stages["parse_chunks"] = timed(lambda: list(ged2sql.parse_chunks(gedcom_path, workers)))
+    os.makedirs(ged2sql.DB_DIR, exist_ok=True)
+    db_path = os.path.join(ged2sql.DB_DIR, "benchmark.db")
+    db = Database(db_path)
+    db.create_family_db()
+    results["rows"], stages["add_data"] = timed(ged2sql.add_data, ged2sql.element_batches(elements), db)
+    del elements
+    _, stages["indexing"] = timed(db.upgrade_family_db)
+    db.close()
+
+    db = sql2json.get_tree_db("benchmark")
+    raw_individuals, stages["get_individuals_data"] = timed(sql2json.get_individuals_data, db)
+    jsonified, stages["jsonify"] = timed(sql2json.jsonify, raw_individuals)
+    output, stages["remove_isolated_individuals"] = timed(sql2json.remove_isolated_individuals, jsonified, sql2json.MIN_COMPONENT_SIZE)
+    _, stages["encode_json"] = timed(sql2json.encode_json, output)
+    results["displayed_people"] = len(output)
+    del raw_individuals, jsonified, output
+    _, stages["stream_json"] = timed(lambda: sum(len(chunk) for chunk in sql2json.stream_json(db)))
+
+    # Time /api/tree end to end, as a logged in user who owns the tree.
+    # The first request for each format streams the tree from the DB and builds the cache, later ones are sent from the cache.
+    client = TestClient(api.api)
+    response = client.post("/login/create", data={"username": "benchmark", "email": "benchmark@example.com", "password": "Benchmark-Passw0rd!"})
+    if response.status_code != 200:
+        raise RuntimeError(f"Could not create the benchmark user: {response.text}")
+    auth.db.add_tree_to_user("benchmark", "benchmark")
+    for format in sql2json.FORMATS:
+        for encoding in ("gzip", "identity"):
+            sql2json.invalidate_cache("benchmark")
+            times = []
+            for _ in range(args.repeats + 1):
+                response, elapsed = timed(client.get, "/tree", params={"tree": "benchmark", "format": format}, headers={"Accept-Encoding": encoding})
+                if response.status_code != 200:
+                    raise RuntimeError(f"/api/tree returned {response.status_code}: {response.text}")
+                times.append(elapsed)
+            stages[f"api_tree_{format}_{encoding}_uncached"] = times[0]
+            stages[f"api_tree_{format}_{encoding}_cached"] = min(times[1:])
+            results[f"{format}_{encoding}_bytes"] = len(response.content) if encoding == "identity" else int(response.headers.get("content-length", 0))
+
+    results["stages"] = {stage: round(seconds, 4) for stage, seconds in stages.items()}
+    results["peak_memory_mb"] = peak_memory()
+
+    print(f"{'stage':>40} {'seconds':>10}")
+    for stage, seconds in stages.items():
+        print(f"{stage:>40} {seconds:>10.3f}")
+    return results
+
+##### ENCODE BENCHMARK #####
+# Build a synthetic tree of {people} people in the same format as sql2json.jsonify, without going through a gedcom file or DB.
+# Each person has a mother and father from earlier in the list, and most have one or two partners.
+# The same seed always gives the same tree.
+def synthetic_tree(people, seed=0):
+    rng = random.Random(seed)
+    tree = []
+    for n in range(people):
+        # The first 100 people have no parents, everyone else has parents from earlier in the list.
+        if n < 100:
+            mid, fid = None, None
+        else:
+            mid = str(rng.randrange(n // 2, n) + 1)
+            fid = str(rng.randrange(n // 2, n) + 1)
+        pids = [str(rng.randrange(people) + 1) for _ in range(rng.choice([0, 1, 1, 1, 2]))]
+        year = 1600 + n * 400 // people
+        tree.append({
+            "id": str(n + 1),
+            "Name": f"Person{n} Surname{n % 1000}",
+            "gender": rng.choice(["male", "female"]),
+            "Birth Date": f"{rng.randrange(1, 29)} JAN {year}",
+            "Birth Place": rng.choice(PLACES),
+            "Death Date": rng.choice(["", f"ABT {year + 60}"]),
+            "Death Place": rng.choice(PLACES),
+            "Occupation": rng.choice(OCCUPATIONS + [""]),
+            "mid": mid,
+            "fid": fid,
+            "pids": pids
+        })
+    return tree
+
+# Time each way of encoding a tree, on synthetic trees of each size, taking the best of {repeats} runs:
+# - fastapi: FastAPI's default path, jsonable_encoder then the json module, as used by JSONResponse
+# - json: the json module on its own
+# - encode_json: sql2json.encode_json, which uses orjson if it is installed
+def run_encode(args, work_dir):
+    os.chdir(work_dir)
+    from fastapi.encoders import jsonable_encoder
+    import sql2json
+
+    encoders = {
+        "fastapi": lambda tree: json.dumps(jsonable_encoder(tree), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8"),
+        "json": lambda tree: json.dumps(tree, separators=(",", ":")).encode("utf-8"),
+        "encode_json": sql2json.encode_json,
+    }
+    if sql2json.orjson is None:
+        print("orjson is not installed, encode_json is using the json module")
+
+    results = {"orjson": sql2json.orjson is not None, "sizes": {}}
+    print(f"{'people':>10} {'encoder':>12} {'seconds':>10} {'MB':>8} {'speedup':>8}")
+    for size in args.sizes:
+        tree = synthetic_tree(size)
+        results["sizes"][size] = {}
+        baseline = None
+        for name, encoder in encoders.items():
+            best = None
+            for _ in range(args.repeats):
+                output, elapsed = timed(encoder, tree)
+                if best is None or elapsed < best:
+                    best = elapsed
+            if baseline is None:
+                baseline = best
+            results["sizes"][size][name] = {"seconds": round(best, 4), "bytes": len(output)}
+            print(f"{size:>10} {name:>12} {best:>10.3f} {len(output) / 1e6:>8.1f} {baseline / best:>7.1f}x")
+    return results
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Benchmark the gedcom import and tree rendering pipeline")
+    arg_parser.add_argument("--results", default=RESULTS_FILE, help="File the results are appended to, as one line of JSON per run")
+    arg_parser.add_argument("--repeats", type=int, default=3, help="Runs of each repeated measurement, the fastest is reported")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    # The options for the synthetic gedcom file, shared by the pipeline and generate commands.
+    tree_options = argparse.ArgumentParser(add_help=False)
+    tree_options.add_argument("--generations", type=int, default=6, help="Generations after the founders")
+    tree_options.add_argument("--branching", type=float, default=2.0, help="Average number of children per marriage")
+    tree_options.add_argument("--founders", type=int, default=10, help="Couples in the first generation")
+    tree_options.add_argument("--marriage", type=float, default=0.8, help="Chance of each person marrying")
+    tree_options.add_argument("--remarriage", type=float, default=0.1, help="Chance of a married person marrying twice")
+    tree_options.add_argument("--missing-parents", type=float, default=0.05, help="Chance of a family leaving out a parent")
+    tree_options.add_argument("--seed", type=int, default=0, help="Seed for the random generator")
+
+    commands.add_parser("pipeline", parents=[tree_options], help="Time each stage of importing and serving a synthetic tree")
+    generate = commands.add_parser("generate", parents=[tree_options], help="Write a synthetic gedcom file without benchmarking it")
+    generate.add_argument("output", help="Path to write the gedcom file to")
+    encode = commands.add_parser("encode", help="Compare ways of encoding tree JSON")
+    encode.add_argument("--sizes", type=int, nargs="+", default=ENCODE_SIZES, help="Numbers of people in each synthetic tree")
+    args = arg_parser.parse_args()
+
+    if args.command == "generate":
+        people, families = generate_gedcom(args.output, args.generations, args.branching, args.founders,
+                                           args.marriage, args.remarriage, args.missing_parents, args.seed)
+        print(f"Wrote {people} people and {families} families to {args.output}")
+        return
+
+    results_path = os.path.abspath(args.results)
+    parameters = {key: value for key, value in vars(args).items() if key not in ("command", "results")}
+    work_dir = tempfile.mkdtemp(prefix="benchmark-")
+    try:
+        if args.command == "pipeline":
+            results = run_pipeline(args, work_dir)
+        else:
+            results = run_encode(args, work_dir)
+    finally:
+        os.chdir(os.path.dirname(results_path))
+        shutil.rmtree(work_dir, ignore_errors=True)
+    save_results(results_path, args.command, parameters, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+import unicodedata
+import tempfile
+import codecs
+import mmap
+import os
+import re
+
+# Gedcom files can be in several character sets, given by the CHAR line of their header (e.g. 1 CHAR ANSEL).
+# The rest of the import (and python-gedcom) reads files as UTF-8, so files in any other character set
+# are converted to UTF-8 once, before they are imported, by ensure_utf8.
+
+# The number of characters converted at a time.
+BLOCK_SIZE = 1024 * 1024
+
+# The names used on a header's CHAR line, and the codecs they are decoded with.
+# Programs which say their files are ASCII or ANSI usually write Windows' code page, which is a superset of ASCII.
+# ANSEL has no Python codec, so it is decoded by decode_ansel.
+CHARSETS = {
+    'UTF-8': 'utf-8',
+    'UTF8': 'utf-8',
+    'UNICODE': 'utf-8', # UTF-16 files are found from their byte order mark or zero bytes instead.
+    'ANSEL': 'ansel',
+    'ASCII': 'cp1252',
+    'ANSI': 'cp1252',
+    'WINDOWS-1252': 'cp1252',
+    'CP1252': 'cp1252',
+    'IBM WINDOWS': 'cp1252',
+    'IBMPC': 'cp437',
+    'MACINTOSH': 'mac_roman',
+    'ISO-8859-1': 'latin-1',
+    'ISO8859-1': 'latin-1',
+    'LATIN1': 'latin-1',
+}
+
+##### ANSEL #####
+# ANSEL's spacing characters, which each map to one Unicode character.
+ANSEL_SPACING = {
+    0xA1: 'Ł', 0xA2: 'Ø', 0xA3: 'Đ', 0xA4: 'Þ', 0xA5: 'Æ', 0xA6: 'Œ', 0xA7: 'ʹ',
+    0xA8: '·', 0xA9: '♭', 0xAA: '®', 0xAB: '±', 0xAC: 'Ơ', 0xAD: 'Ư', 0xAE: 'ʼ',
+    0xB0: 'ʻ', 0xB1: 'ł', 0xB2: 'ø', 0xB3: 'đ', 0xB4: 'þ', 0xB5: 'æ', 0xB6: 'œ',
+    0xB7: 'ʺ', 0xB8: 'ı', 0xB9: '£', 0xBA: 'ð', 0xBC: 'ơ', 0xBD: 'ư', 0xBE: '□',
+    0xBF: '■', 0xC0: '°', 0xC1: 'ℓ', 0xC2: '℗', 0xC3: '©', 0xC4: '♯', 0xC5: '¿',
+    0xC6: '¡', 0xC7: 'ß', 0xC8: '€', 0xCF: 'ß',
+}
+# ANSEL's combining diacritics, which come before the character they go on (Unicode's combining characters come after it).
+ANSEL_COMBINING = {
+    0xE0: '\u0309', 0xE1: '\u0300', 0xE2: '\u0301', 0xE3: '\u0302', 0xE4: '\u0303', 0xE5: '\u0304', 0xE6: '\u0306',
+    0xE7: '\u0307', 0xE8: '\u0308', 0xE9: '\u030c', 0xEA: '\u030a', 0xEB: '\ufe20', 0xEC: '\ufe21', 0xED: '\u0315',
+    0xEE: '\u030b', 0xEF: '\u0310', 0xF0: '\u0327', 0xF1: '\u0328', 0xF2: '\u0323', 0xF3: '\u0324', 0xF4: '\u0325',
+    0xF5: '\u0333', 0xF6: '\u0332', 0xF7: '\u0326', 0xF8: '\u031c', 0xF9: '\u032e', 0xFA: '\ufe22', 0xFB: '\ufe23',
+    0xFE: '\u0313',
+}
+# Table for str.translate, turning text decoded as latin-1 (one character per byte) into Unicode.
+# Bytes above 0x7F which ANSEL doesn't use become the replacement character.
+ANSEL_TABLE = {byte: ANSEL_SPACING.get(byte, ANSEL_COMBINING.get(byte, '\ufffd')) for byte in range(0x80, 0x100)}
+# One or more combining diacritics, followed by the character they go on (if it is on the same line).
+COMBINING_SEQUENCE = re.compile('([' + ''.join(ANSEL_COMBINING.values()) + ']+)([^\r\n' + ''.join(ANSEL_COMBINING.values()) + ']?)')
+
+# Moves each run of combining diacritics after the character they go on, then combines them where Unicode has a single character
+# for the combination (e.g. e and an acute accent become é).
+def combine_diacritics(match):
+    diacritics, base = match.groups()
+    return unicodedata.normalize('NFC', base + diacritics)
+
+# Decode ANSEL text which has been read as latin-1, so each character is one byte of the file.
+def decode_ansel(text):
+    return COMBINING_SEQUENCE.sub(combine_diacritics, text.translate(ANSEL_TABLE))
+
+# Decode lines of ANSEL text which have been read as latin-1.
+# Almost every line is ASCII, which is the same in ANSEL, and checking whether a str is ASCII doesn't have to look at its characters,
+# so only the lines with other characters in them are decoded.
+def decode_ansel_lines(lines):
+    text = ''.join(lines)
+    if text.isascii():
+        return text
+    return ''.join([line if line.isascii() else decode_ansel(line) for line in lines])
+
+##### DETECTING AND CONVERTING #####
+# Split a gedcom line into its level, xref, tag and value, as bytes, without decoding it,
+# e.g. b'0 @I1@ INDI\n' gives (b'0', b'@I1@', b'INDI', b'') and b'1 CHAR ANSEL\r\n' gives (b'1', None, b'CHAR', b'ANSEL').
+def split_line(line):
+    fields = line.strip().split(None, 1)
+    if not fields:
+        return b'', None, b'', b''
+    level = fields[0]
+    rest = fields[1] if len(fields) > 1 else b''
+    xref = None
+    if rest.startswith(b'@'):
+        xref, _, rest = rest.partition(b' ')
+        rest = rest.lstrip()
+    tag, _, value = rest.partition(b' ')
+    return level, xref, tag, value
+
+# Work out the encoding of a gedcom file, returning the name of a Python codec, or 'ansel'.
+# UTF-16 is found from the byte order mark, or from the zero byte next to the first line's level.
+# Otherwise, the CHAR line of the header is used, and files without one are taken to be UTF-8.
+# The file is memory mapped, so only the pages holding the header are read.
+def detect_charset(gedcom_path):
+    with open(gedcom_path, 'rb') as gedcom_stream:
+        if os.fstat(gedcom_stream.fileno()).st_size == 0:
+            return 'utf-8'
+        with mmap.mmap(gedcom_stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = data[:4]
+            if start.startswith(codecs.BOM_UTF8):
+                return 'utf-8'
+            if start.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+                return 'utf-16'
+            if start.startswith(b'0\x00'):
+                return 'utf-16-le'
+            if start.startswith(b'\x000'):
+                return 'utf-16-be'
+
+            # Read the header, which ends at the next level 0 line.
+            for line_number, line in enumerate(iter(data.readline, b'')):
+                level, xref, tag, value = split_line(line)
+                if level == b'0' and line_number > 0:
+                    break
+                if level == b'1' and tag == b'CHAR':
+                    return CHARSETS.get(value.strip().upper().decode('ascii', 'replace'), 'utf-8')
+    return 'utf-8'
+
+# Check whether a file is valid UTF-8, decoding it BLOCK_SIZE bytes at a time.
+def is_utf8(gedcom_path):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(gedcom_path, 'rb') as gedcom_stream:
+            for block in iter(lambda: gedcom_stream.read(BLOCK_SIZE), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+# Rewrite the header's CHAR line (in the first lines read from a file) to say UTF-8, keeping its line ending.
+# Returns True once the end of the header has been seen, after which there is nothing left to rewrite.
+def rewrite_char_line(lines):
+    for i, line in enumerate(lines):
+        level, xref, tag, value = split_line(line.lstrip('\ufeff').encode('utf-8'))
+        if level == b'0' and i > 0:
+            return True
+        if level == b'1' and tag == b'CHAR':
+            lines[i] = '1 CHAR UTF-8' + line[len(line.rstrip('\r\n')):]
+    return False
+
+# Convert a gedcom file from the given encoding to UTF-8, replacing the file.
+# Characters which can't be decoded become the replacement character rather than stopping the import.
+# Line endings are kept as they are. The converted file is written to a temporary file and renamed over the original,
+# so the original is left as it was if the conversion fails.
+def convert_to_utf8(gedcom_path, encoding):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(gedcom_path) or '.', suffix='.tmp')
+    try:
+        # ANSEL is read as latin-1, which gives one character per byte for decode_ansel.
+        source_encoding = 'latin-1' if encoding == 'ansel' else encoding
+        with open(gedcom_path, encoding=source_encoding, errors='replace', newline='') as source, \
+             os.fdopen(fd, 'w', encoding='utf-8', newline='') as target:
+            header_done = False
+            while True:
+                lines = source.readlines(BLOCK_SIZE)
+                if not lines:
+                    break
+                if not header_done:
+                    header_done = rewrite_char_line(lines)
+                if encoding == 'ansel':
+                    target.write(decode_ansel_lines(lines))
+                else:
+                    target.write(''.join(lines))
+        os.replace(tmp_path, gedcom_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Make sure a gedcom file is UTF-8 before it is imported, converting it if it isn't, and return the encoding it was in.
+# Files which say they are UTF-8 (or don't say) aren't checked, so the common case doesn't read the whole file an extra time.
+# Files which say they are in another 8-bit character set are often plain ASCII, or are really UTF-8,
+# so they are only converted if they aren't already valid UTF-8.
+def ensure_utf8(gedcom_path):
+    encoding = detect_charset(gedcom_path)
+    if encoding == 'utf-8':
+        return encoding
+    if not encoding.startswith('utf-16') and is_utf8(gedcom_path):
+        return 'utf-8'
+    convert_to_utf8(gedcom_path, encoding)
+    return encoding
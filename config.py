@@ -1,17 +1,41 @@
 from configparser import ConfigParser, ExtendedInterpolation
 import os
 
+# Default config values.
+# These are written to config.ini when it is first created,
+# and are also used for any keys missing from an older config.ini.
+DEFAULTS = {
+    'user_data_dir': 'user_data',
+    'gedcom_dir': '${user_data_dir}/gedcom',
+    'db_dir': '${user_data_dir}/trees',
+    'api_port': '8085',
+    'session_ttl': '2',
+    'session_cache_ttl': '60',
+    'session_sweep_interval': '300',
+    'revocation_check_interval': '1',
+    'argon2_time_cost': '3',
+    'argon2_memory_cost': '65536',
+    'argon2_parallelism': '4',
+    'hash_workers': '2',
+    'import_workers': '2',
+    'job_retention': '3600',
+    'tree_name': 'SET_NAME',
+    'host_ip': '127.0.0.1',
+    'min_component_size': '2',
+    'auth_db_readers': '4',
+    'tree_db_readers': '2',
+    'max_search_results': '100',
+    'api_workers': '0',
+    'parse_workers': '0',
+    'max_upload_size': '512',
+    'max_timeline_results': '1000',
+    'max_subtree_generations': '10',
+}
+
 # Set default config values
 def setup():
     config = ConfigParser(interpolation=ExtendedInterpolation()) # Allows the config to use nested variables.
-    default = config['DEFAULT']
-    default['user_data_dir'] = 'user_data'
-    default['gedcom_dir'] = '${user_data_dir}/gedcom'
-    default['db_dir'] = '${user_data_dir}/trees'
-    default['api_port'] = '8085'
-    default['session_ttl'] = '2'
-    default['tree_name'] = 'SET_NAME'
-    default['host_ip'] = '127.0.0.1'
+    config.read_dict({'DEFAULT': DEFAULTS})
     with open('config.ini', 'w') as configfile:
         config.write(configfile)
 
@@ -21,9 +45,11 @@ def get_cfg() -> dict[str, str]:
     # Check if the config file exists, if not then run setup()
     if not os.path.exists('config.ini'):
         setup()
-    # Read the config file, add each key to a dictionary then return the dictionary
+    # Read the defaults, then the config file over the top of them,
+    # add each key to a dictionary then return the dictionary
+    config.read_dict({'DEFAULT': DEFAULTS})
     config.read('config.ini')
     cfg = {}
     for key in config['DEFAULT']:
         cfg[key] = config.get('DEFAULT', key)
-    return cfg
\ No newline at end of file
+    return cfg
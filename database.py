@@ -1,332 +1,1222 @@
+from contextlib import contextmanager
+import threading
 import sqlite3
+import queue
+import json
+import time
+import metrics
+import dates
+
+# The version of the family tree DB layout, stored in each tree DB's user_version.
+# When a tree DB with an older version is opened, upgrade_family_db brings it up to date in place.
+FAMILY_SCHEMA_VERSION = 6
+
+# The columns of the individuals table which are sent to the website, in order.
+# Queries list these rather than using *, as the table also has a record_hash column.
+INDIVIDUAL_COLUMNS = ['id', 'first_name', 'last_name', 'gender', 'birth_date', 'birth_place', 'death_date', 'death_place', 'occupation']
+
+# The dates which are parsed into ranges by build_dates, and the table each is in.
+# Each has {event}_earliest and {event}_latest columns holding day numbers, and an {event}_qualifier column (see dates.py).
+DATE_EVENTS = {'birth': 'individuals', 'death': 'individuals', 'marriage': 'families'}
+
+# Cursor which records how long each statement takes to execute in metrics.QUERY_DURATION,
+# labelled with the connection's DB name and the first keyword of the statement (e.g. SELECT or INSERT).
+# For a SELECT, this is the time taken to get the first row, which includes any sorting or grouping.
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.record_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.connection.record_query(sql, time.perf_counter() - start)
+
+# Connection which uses TimedCursor for every statement, including ones run with conn.execute().
+class TimedConnection(sqlite3.Connection):
+    name = 'db'
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or TimedCursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def record_query(self, sql, duration):
+        statement = sql.lstrip().split(None, 1)[0].upper() if sql.strip() else ''
+        metrics.QUERY_DURATION.observe(duration, db=self.name, statement=statement)
 
 class Database:
-    def __init__(self, db_path):
+    # Each Database has one write connection (db_conn), and optionally a pool of {readers} read-only connections.
+    # Any thread can use the Database: methods check out a connection with writer() or reader() for as long as they need it,
+    # so no two threads use the same connection at once.
+    # If wal is True, the DB is put into WAL mode, so readers don't block the writer and the writer doesn't block readers.
+    # name labels the DB's queries in the metrics, e.g. 'auth' or 'tree'.
+    def __init__(self, db_path, readers=0, wal=False, name='tree'):
         self.db_path = db_path # Set the path for the Database file to be opened/created.
-        # Initiate DB connection and enforce foreign keys.
+        self.name = name
+        self.write_lock = threading.RLock()
+        self.read_pool = queue.Queue()
+        self.readers = readers
+        # Initiate DB connections and enforce foreign keys.
         try:
-            self.db_conn = sqlite3.connect(db_path)
-            self.db_conn.execute("PRAGMA foreign_keys = ON") # Enforces Foreign Keys
-            #self.db_conn.set_trace_callback(lambda s: print("SQL:", s)) # DEBUG: Print all SQL messages.
+            self.db_conn = self.connect()
+            if wal:
+                self.db_conn.execute("PRAGMA journal_mode = WAL")
+                self.db_conn.execute("PRAGMA synchronous = NORMAL") # Safe with WAL, and avoids an fsync on every commit.
+            for _ in range(readers):
+                read_conn = self.connect()
+                read_conn.execute("PRAGMA query_only = ON") # Read connections can never write by mistake.
+                self.read_pool.put(read_conn)
         except sqlite3.Error as e:
             print(f"SQL Error Occurred: {e}")
 
+    # Open a connection to the DB file.
+    # check_same_thread is turned off as connections are handed between threads, but only used by one thread at a time.
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, factory=TimedConnection)
+        conn.name = self.name
+        conn.execute("PRAGMA foreign_keys = ON") # Enforces Foreign Keys
+        #conn.set_trace_callback(lambda s: print("SQL:", s)) # DEBUG: Print all SQL messages.
+        return conn
+
+    # Check out the write connection, waiting for any other thread using it to finish.
+    @contextmanager
+    def writer(self):
+        with self.write_lock:
+            yield self.db_conn
+
+    # Check out a read connection from the pool, waiting for one to be free, and return it to the pool afterwards.
+    # If the Database has no read connections, the write connection is used instead.
+    @contextmanager
+    def reader(self):
+        if self.readers == 0:
+            with self.writer() as conn:
+                yield conn
+            return
+        conn = self.read_pool.get()
+        try:
+            yield conn
+        finally:
+            self.read_pool.put(conn)
+
     ### ADDING TREE DATA ###
 
     def create_family_db(self):
-        cursor = self.db_conn.cursor()
-        # Create individuals table
-        cursor.execute('''
-           CREATE TABLE IF NOT EXISTS individuals (
-              id TEXT PRIMARY KEY,
-              first_name TEXT,
-              last_name TEXT,
-              gender TEXT,
-              birth_date TEXT,
-              birth_place TEXT,
-              death_date TEXT,
-              death_place TEXT,
-              occupation TEXT            
-            )
-           ''')
-        # Create families table
-        cursor.execute('''
-           CREATE TABLE IF NOT EXISTS families (
-               id TEXT PRIMARY KEY,
-               father_id TEXT,
-               mother_id TEXT,
-               marriage_date TEXT,
-               marriage_place TEXT,
-               FOREIGN KEY(mother_id) REFERENCES individuals(id) ON DELETE SET NULL,
-               FOREIGN KEY(father_id) REFERENCES individuals(id) ON DELETE SET NULL
-           )    
-           ''')
-
-        # Creates linked table of family_children, which exists to keep track of the children each family has.
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS family_children (
-                family_id TEXT NOT NULL,
-                child_id TEXT NOT NULL,
-                PRIMARY KEY (family_id, child_id),
-                FOREIGN KEY(family_id) REFERENCES families(id) ON DELETE CASCADE,
-                FOREIGN KEY(child_id) REFERENCES individuals(id) ON DELETE CASCADE
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            # Create individuals table
+            cursor.execute('''
+               CREATE TABLE IF NOT EXISTS individuals (
+                  id TEXT PRIMARY KEY,
+                  first_name TEXT,
+                  last_name TEXT,
+                  gender TEXT,
+                  birth_date TEXT,
+                  birth_place TEXT,
+                  death_date TEXT,
+                  death_place TEXT,
+                  occupation TEXT,
+                  record_hash TEXT,
+                  birth_earliest INTEGER,
+                  birth_latest INTEGER,
+                  birth_qualifier TEXT,
+                  death_earliest INTEGER,
+                  death_latest INTEGER,
+                  death_qualifier TEXT
                 )
-        ''')
-        self.db_conn.commit()
+               ''')
+            # Create families table
+            cursor.execute('''
+               CREATE TABLE IF NOT EXISTS families (
+                   id TEXT PRIMARY KEY,
+                   father_id TEXT,
+                   mother_id TEXT,
+                   marriage_date TEXT,
+                   marriage_place TEXT,
+                   record_hash TEXT,
+                   marriage_earliest INTEGER,
+                   marriage_latest INTEGER,
+                   marriage_qualifier TEXT,
+                   FOREIGN KEY(mother_id) REFERENCES individuals(id) ON DELETE SET NULL,
+                   FOREIGN KEY(father_id) REFERENCES individuals(id) ON DELETE SET NULL
+               )    
+               ''')
+
+            # Creates linked table of family_children, which exists to keep track of the children each family has.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS family_children (
+                    family_id TEXT NOT NULL,
+                    child_id TEXT NOT NULL,
+                    PRIMARY KEY (family_id, child_id),
+                    FOREIGN KEY(family_id) REFERENCES families(id) ON DELETE CASCADE,
+                    FOREIGN KEY(child_id) REFERENCES individuals(id) ON DELETE CASCADE
+                    )
+            ''')
+            conn.commit()
 
 
     # add_person_data takes information about an individual and adds them to the individuals table.
     def add_person_data(self, id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO individuals (
-                id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-            id,
-            first_name,
-            last_name,
-            gender,
-            birth_date,
-            birth_place,
-            death_date,
-            death_place,
-            occupation
-        ))
-        self.db_conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO individuals (
+                    id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                id,
+                first_name,
+                last_name,
+                gender,
+                birth_date,
+                birth_place,
+                death_date,
+                death_place,
+                occupation
+            ))
+            conn.commit()
 
     # add_family_data takes information about a family and adds it to the families table
     def add_family_data(self, id, father_id, mother_id, marriage_date, marriage_place):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO families (
-                id, father_id, mother_id, marriage_date, marriage_place)
-            VALUES (?, ?, ?, ?, ?)
-           ''', (
-               id,
-               father_id,
-               mother_id,
-               marriage_date,
-               marriage_place,
-           ))
-        self.db_conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR IGNORE INTO families (
+                    id, father_id, mother_id, marriage_date, marriage_place)
+                VALUES (?, ?, ?, ?, ?)
+               ''', (
+                   id,
+                   father_id,
+                   mother_id,
+                   marriage_date,
+                   marriage_place,
+               ))
+            conn.commit()
 
     # Add a child to the family_children table
     def add_family_child(self, family_id, child_id):
-        cursor = self.db_conn.cursor()
+        with self.writer() as conn:
+            cursor = conn.cursor()
 
-        # If the family does not exist, skip silently
-        cursor.execute('SELECT 1 FROM families WHERE id = ?', (family_id,))
-        if not cursor.fetchone():
-            return
+            # If the family does not exist, skip silently
+            cursor.execute('SELECT 1 FROM families WHERE id = ?', (family_id,))
+            if not cursor.fetchone():
+                return
 
-        # If the child does not exist, skip silent
-        cursor.execute('SELECT 1 FROM individuals WHERE id = ?', (child_id,))
-        if not cursor.fetchone():
-            return
+            # If the child does not exist, skip silent
+            cursor.execute('SELECT 1 FROM individuals WHERE id = ?', (child_id,))
+            if not cursor.fetchone():
+                return
+
+            cursor.execute('''
+                INSERT OR IGNORE INTO family_children (family_id, child_id)
+                VALUES (?, ?)
+            ''', (family_id, child_id))
+            conn.commit()
+
+    # Creates the secondary indexes on the family tree tables.
+    # family_children's primary key starts with family_id, so finding the families a child is in needs an index on child_id,
+    # and finding the families a person is a parent in needs indexes on father_id and mother_id.
+    # The name and date indexes are used when searching for people.
+    # These are created after the data is loaded, as building an index once is faster than updating it for every row.
+    def create_family_indexes(self):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_family_children_child ON family_children(child_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_families_father ON families(father_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_families_mother ON families(mother_id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuals_name ON individuals(last_name, first_name)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuals_first_name ON individuals(first_name)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuals_birth_date ON individuals(birth_date)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_individuals_death_date ON individuals(death_date)')
+            conn.commit()
 
+    # Creates the full-text search index over individuals if it doesn't exist, and fills it from the individuals table.
+    # individuals_search is an FTS5 'external content' table, so it only stores the index and reads the text from individuals.
+    # Diacritics are ignored when matching (e.g. 'Jose' finds 'José'), and prefixes of 2 and 3 characters
+    # are indexed separately so prefix searches don't have to scan every term in the index.
+    # The index is not updated when individuals changes, so this is run again after every import.
+    def build_search_index(self):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS individuals_search USING fts5(
+                    first_name,
+                    last_name,
+                    birth_place,
+                    death_place,
+                    occupation,
+                    content='individuals',
+                    content_rowid='rowid',
+                    tokenize='unicode61 remove_diacritics 2',
+                    prefix='2 3'
+                )
+            ''')
+            cursor.execute("INSERT INTO individuals_search(individuals_search) VALUES('rebuild')")
+            conn.commit()
+
+    # Adds the record_hash column to the individuals and families tables of DBs created before it existed.
+    # The hashes of existing rows are left NULL, so they are all treated as changed by the next incremental import.
+    def add_record_hash_columns(self):
+        with self.writer() as conn:
+            for table in ('individuals', 'families'):
+                columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+                if 'record_hash' not in columns:
+                    conn.execute(f'ALTER TABLE {table} ADD COLUMN record_hash TEXT')
+            conn.commit()
+
+    # Creates the edges table if it doesn't exist, and fills it from families and family_children.
+    # edges holds every relationship as a row from one person to another, in both directions:
+    # - 'father' and 'mother': related_id is a parent of person_id
+    # - 'child': related_id is a child of person_id
+    # - 'spouse': related_id is a partner of person_id (only for families with both parents)
+    # position orders the edges in the order they were added: it is the rowid of the family_children row for parents and children,
+    # and the rowid of the family for spouses. family_id is the family the edge comes from.
+    # The primary key starts with person_id and kind, so all of one kind of relative of a person is one index range,
+    # and the table is WITHOUT ROWID so that range holds the whole row. idx_edges_family finds the edges of a family when it changes.
+    # If a list of family IDs is given, only the edges of those families are added, otherwise the table is rebuilt.
+    def build_edges(self, family_ids=None):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS edges (
+                    person_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    related_id TEXT NOT NULL,
+                    family_id TEXT NOT NULL,
+                    PRIMARY KEY (person_id, kind, position, related_id)
+                ) WITHOUT ROWID
+            ''')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_edges_family ON edges(family_id)')
+            if family_ids is None:
+                cursor.execute('DELETE FROM edges')
+                family_filter = ''
+                params = ()
+            else:
+                family_filter = 'AND families.id IN (SELECT value FROM json_each(:families))'
+                params = {'families': json.dumps(family_ids)}
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO edges (person_id, kind, position, related_id, family_id)
+                SELECT family_children.child_id, 'father', family_children.rowid, families.father_id, families.id
+                FROM family_children JOIN families ON families.id = family_children.family_id
+                WHERE families.father_id IS NOT NULL {family_filter}
+                UNION ALL
+                SELECT family_children.child_id, 'mother', family_children.rowid, families.mother_id, families.id
+                FROM family_children JOIN families ON families.id = family_children.family_id
+                WHERE families.mother_id IS NOT NULL {family_filter}
+                UNION ALL
+                SELECT families.father_id, 'child', family_children.rowid, family_children.child_id, families.id
+                FROM family_children JOIN families ON families.id = family_children.family_id
+                WHERE families.father_id IS NOT NULL {family_filter}
+                UNION ALL
+                SELECT families.mother_id, 'child', family_children.rowid, family_children.child_id, families.id
+                FROM family_children JOIN families ON families.id = family_children.family_id
+                WHERE families.mother_id IS NOT NULL {family_filter}
+                UNION ALL
+                SELECT families.father_id, 'spouse', families.rowid, families.mother_id, families.id
+                FROM families
+                WHERE families.father_id IS NOT NULL AND families.mother_id IS NOT NULL {family_filter}
+                UNION ALL
+                SELECT families.mother_id, 'spouse', families.rowid, families.father_id, families.id
+                FROM families
+                WHERE families.father_id IS NOT NULL AND families.mother_id IS NOT NULL {family_filter}
+            ''', params)
+            conn.commit()
+
+    # Adds the parsed date columns to the individuals and families tables of DBs created before they existed.
+    def add_date_columns(self):
+        with self.writer() as conn:
+            for event, table in DATE_EVENTS.items():
+                columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+                for column, column_type in ((f'{event}_earliest', 'INTEGER'), (f'{event}_latest', 'INTEGER'), (f'{event}_qualifier', 'TEXT')):
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+            conn.commit()
+
+    # Fills in the parsed date columns from the birth, death and marriage dates, using dates.parse_date as an SQL function.
+    # Each date is indexed on (earliest, latest), so dates in a range can be found with an index range scan.
+    # date_spans holds the longest range (latest - earliest) of each event, which gives get_timeline a lower bound for its scans:
+    # a date which ends after the start of a search can't start more than the longest span before it.
+    # It also holds the longest 'lifetime', from the start of someone's birth date to the end of their death date
+    # (or dates.LIFESPAN_YEARS after their birth date if they have no death date), which bounds get_timeline's 'alive' scans in the same way.
+    # If lists of individual and family IDs are given, only those rows are updated and the spans can only grow,
+    # otherwise every row is updated and the spans are worked out again.
+    # If commit is False, the changes are left in the connection's transaction, for apply_changes to commit.
+    def build_dates(self, individual_ids=None, family_ids=None, commit=True):
+        with self.writer() as conn:
+            conn.create_function('gedcom_date', 2, dates.parse_date_part, deterministic=True)
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS date_spans (
+                    event TEXT PRIMARY KEY,
+                    span INTEGER NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            if individual_ids is None and family_ids is None:
+                cursor.execute('DELETE FROM date_spans')
+            ids = {'individuals': individual_ids, 'families': family_ids}
+            for table in ('individuals', 'families'):
+                events = [event for event, event_table in DATE_EVENTS.items() if event_table == table]
+                # The SELECT in an upsert needs a WHERE clause, or SQLite reads ON CONFLICT as part of the FROM clause.
+                if individual_ids is None and family_ids is None:
+                    row_filter = 'WHERE true'
+                    params = ()
+                else:
+                    row_filter = 'WHERE id IN (SELECT value FROM json_each(?))'
+                    params = (json.dumps(ids[table] or []),)
+                assignments = ', '.join(
+                    f'{event}_earliest = gedcom_date({event}_date, 0), {event}_latest = gedcom_date({event}_date, 1), {event}_qualifier = gedcom_date({event}_date, 2)'
+                    for event in events
+                )
+                cursor.execute(f'UPDATE {table} SET {assignments} {row_filter}', params)
+                for event in events:
+                    cursor.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_{event}_range ON {table}({event}_earliest, {event}_latest)')
+                    cursor.execute(f'''
+                        INSERT INTO date_spans (event, span)
+                        SELECT ?, COALESCE(MAX({event}_latest - {event}_earliest), 0) FROM {table} {row_filter}
+                        ON CONFLICT (event) DO UPDATE SET span = MAX(span, excluded.span)
+                    ''', (event,) + params)
+                if table == 'individuals':
+                    cursor.execute(f'''
+                        INSERT INTO date_spans (event, span)
+                        SELECT 'lifetime', COALESCE(MAX(COALESCE(death_latest, birth_latest + ?) - birth_earliest), 0) FROM individuals {row_filter}
+                        ON CONFLICT (event) DO UPDATE SET span = MAX(span, excluded.span)
+                    ''', (dates.years_to_days(dates.LIFESPAN_YEARS),) + params)
+            if commit:
+                conn.commit()
+
+    # Brings a family tree DB up to FAMILY_SCHEMA_VERSION, then runs ANALYZE so SQLite's query planner knows about the new indexes.
+    # The edges table is left out of ANALYZE: with statistics for it, SQLite adds a Bloom filter to the joins in get_subtree's recursive CTEs,
+    # which means reading the whole table on every call. Every query on edges is a primary key lookup, so it doesn't need them.
+    # This is the indexing stage run by ged2sql after a bulk load, and it is also run whenever a tree DB is opened,
+    # so DB files created by older versions are upgraded in place.
+    # Each step is safe to run on a DB which already has it, so a new DB can go through every step.
+    # Returns True if the DB was upgraded, or False if it was already up to date.
+    def upgrade_family_db(self):
+        with self.writer() as conn:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= FAMILY_SCHEMA_VERSION:
+                return False
+            # Version 1: secondary indexes
+            if version < 1:
+                self.create_family_indexes()
+            # Version 2: full-text search index
+            if version < 2:
+                self.build_search_index()
+            # Version 3: record hashes, used by incremental imports
+            if version < 3:
+                self.add_record_hash_columns()
+            # Version 4: edges table
+            if version < 4:
+                self.build_edges()
+            # Version 5: parsed date ranges
+            if version < 5:
+                self.add_date_columns()
+            # Version 6: lifetime span, used by get_timeline's 'alive' searches (this also fills in the dates for version 5)
+            if version < 6:
+                self.build_dates()
+            for table in ('individuals', 'families', 'family_children'):
+                conn.execute(f'ANALYZE {table}')
+            conn.execute(f'PRAGMA user_version = {FAMILY_SCHEMA_VERSION}')
+            conn.commit()
+            return True
+
+    ### BULK IMPORTING TREE DATA ###
+    # A bulk import is made up of several calls which share one transaction, so these use db_conn directly.
+    # Only one thread should import into a Database at a time, which ged2sql does by opening its own Database for each import.
+
+    # Prepares the connection for a bulk import.
+    # The journal is kept in memory and fsyncs are turned off for the duration of the load,
+    # and foreign keys are disabled so that rows can be written in any order.
+    # Children are written into a temporary staging table, and linked to their families in end_bulk_load.
+    def begin_bulk_load(self):
+        self.db_conn.commit()
+        self.db_conn.execute("PRAGMA journal_mode = MEMORY")
+        self.db_conn.execute("PRAGMA synchronous = OFF")
+        self.db_conn.execute("PRAGMA foreign_keys = OFF")
+        self.db_conn.execute('''
+            CREATE TEMP TABLE IF NOT EXISTS staged_family_children (
+                family_id TEXT,
+                child_id TEXT
+            )
+        ''')
+
+    # add_people adds a batch of individuals in one executemany call, without committing.
+    # Each row is in the same column order as add_person_data, followed by the hash of the individual's gedcom record.
+    def add_people(self, rows):
+        self.db_conn.executemany('''
+            INSERT OR IGNORE INTO individuals (
+                id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation, record_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    # add_families adds a batch of families in one executemany call, without committing.
+    # Each row is in the same column order as add_family_data, followed by the hash of the family's gedcom record.
+    def add_families(self, rows):
+        self.db_conn.executemany('''
+            INSERT OR IGNORE INTO families (
+                id, father_id, mother_id, marriage_date, marriage_place, record_hash)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', rows)
+
+    # stage_family_children stores a batch of (family_id, child_id) pairs in the staging table.
+    # They are only checked and moved into family_children by end_bulk_load.
+    def stage_family_children(self, rows):
+        self.db_conn.executemany('''
+            INSERT INTO staged_family_children (family_id, child_id)
+            VALUES (?, ?)
+        ''', rows)
+
+    # Finishes a bulk import.
+    # Instead of checking that the family and child exist for every child like add_family_child does,
+    # all of the staged children are checked against families and individuals at once.
+    # Parents that do not exist are set to NULL, which is what ON DELETE SET NULL would leave behind.
+    # The whole load is committed as one transaction, then the normal PRAGMAs are restored.
+    def end_bulk_load(self):
+        cursor = self.db_conn.cursor()
         cursor.execute('''
             INSERT OR IGNORE INTO family_children (family_id, child_id)
-            VALUES (?, ?)
-        ''', (family_id, child_id))
+            SELECT staged.family_id, staged.child_id
+            FROM staged_family_children AS staged
+            WHERE staged.family_id IN (SELECT id FROM families)
+            AND staged.child_id IN (SELECT id FROM individuals)
+        ''')
+        cursor.execute('''
+            UPDATE families SET father_id = NULL
+            WHERE father_id IS NOT NULL AND father_id NOT IN (SELECT id FROM individuals)
+        ''')
+        cursor.execute('''
+            UPDATE families SET mother_id = NULL
+            WHERE mother_id IS NOT NULL AND mother_id NOT IN (SELECT id FROM individuals)
+        ''')
+        cursor.execute('DROP TABLE staged_family_children')
         self.db_conn.commit()
+        self.db_conn.execute("PRAGMA foreign_keys = ON")
+        self.db_conn.execute("PRAGMA synchronous = FULL")
+        self.db_conn.execute("PRAGMA journal_mode = DELETE")
+
+    # Abandons a bulk import, rolling back everything written since begin_bulk_load and restoring the normal PRAGMAs.
+    def abort_bulk_load(self):
+        self.db_conn.rollback()
+        self.db_conn.execute('DROP TABLE IF EXISTS staged_family_children')
+        self.db_conn.execute("PRAGMA foreign_keys = ON")
+        self.db_conn.execute("PRAGMA synchronous = FULL")
+        self.db_conn.execute("PRAGMA journal_mode = DELETE")
+
+    ### INCREMENTAL IMPORTING TREE DATA ###
+    # An incremental import compares the hash of each record in a new version of a gedcom file with the hashes stored in the DB,
+    # and only writes the records which have been added, changed or removed.
+
+    # Checks whether the DB already has any tree data in it, in which case an import can be incremental.
+    def has_tree_data(self):
+        with self.reader() as conn:
+            return conn.execute('SELECT EXISTS(SELECT 1 FROM individuals) OR EXISTS(SELECT 1 FROM families)').fetchone()[0] == 1
+
+    # Gets a dictionary mapping the ID of every row in a table ('individuals' or 'families') to its record hash.
+    def get_record_hashes(self, table):
+        with self.reader() as conn:
+            return dict(conn.execute(f'SELECT id, record_hash FROM {table}'))
+
+    # Applies the changes found by an incremental import in one transaction:
+    # - people and families are rows in the same format as add_people and add_families, which are inserted, or replace the existing row
+    # - family_children are (family_id, child_id) pairs, which replace all of the children of the families in families
+    # - deleted_people and deleted_families are lists of IDs to delete
+    # Foreign keys are left on, so deleting a person removes them from family_children and from families they are a parent in.
+    # As with end_bulk_load, parents and children that do not exist are left out.
+    # The full-text search index, the edges table and the parsed dates are updated for just the people and families which changed, rather than being rebuilt.
+    def apply_changes(self, people, families, family_children, deleted_people, deleted_families):
+        search_columns = 'first_name, last_name, birth_place, death_place, occupation'
+        changed_ids = json.dumps([row[0] for row in people] + deleted_people)
+        with self.writer() as conn:
+            try:
+                cursor = conn.cursor()
+                # The edges of every family which changes, is deleted, or has a deleted person in it are removed now and rebuilt at the end.
+                # Edges go both ways, so every family a deleted person is in can be found from the edges starting at them.
+                cursor.execute('''
+                    SELECT DISTINCT family_id FROM edges WHERE person_id IN (SELECT value FROM json_each(?))
+                ''', (json.dumps(deleted_people),))
+                affected_families = list({row[0] for row in cursor} | {row[0] for row in families} | set(deleted_families))
+                cursor.execute('DELETE FROM edges WHERE family_id IN (SELECT value FROM json_each(?))', (json.dumps(affected_families),))
+                # External content FTS5 tables need the old values of a row to remove it from the index.
+                cursor.execute(f'''
+                    INSERT INTO individuals_search(individuals_search, rowid, {search_columns})
+                    SELECT 'delete', rowid, {search_columns}
+                    FROM individuals WHERE id IN (SELECT value FROM json_each(?))
+                ''', (changed_ids,))
+                cursor.executemany('DELETE FROM families WHERE id = ?', [(id,) for id in deleted_families])
+                cursor.executemany('DELETE FROM individuals WHERE id = ?', [(id,) for id in deleted_people])
+                cursor.executemany('''
+                    INSERT INTO individuals (
+                        id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation, record_hash)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        first_name = excluded.first_name,
+                        last_name = excluded.last_name,
+                        gender = excluded.gender,
+                        birth_date = excluded.birth_date,
+                        birth_place = excluded.birth_place,
+                        death_date = excluded.death_date,
+                        death_place = excluded.death_place,
+                        occupation = excluded.occupation,
+                        record_hash = excluded.record_hash
+                ''', people)
+                cursor.execute(f'''
+                    INSERT INTO individuals_search(rowid, {search_columns})
+                    SELECT rowid, {search_columns}
+                    FROM individuals WHERE id IN (SELECT value FROM json_each(?))
+                ''', (changed_ids,))
+                # Parents are looked up so that any which do not exist are set to NULL rather than breaking the foreign key.
+                cursor.executemany('''
+                    INSERT INTO families (id, father_id, mother_id, marriage_date, marriage_place, record_hash)
+                    VALUES (?, (SELECT id FROM individuals WHERE id = ?), (SELECT id FROM individuals WHERE id = ?), ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        father_id = excluded.father_id,
+                        mother_id = excluded.mother_id,
+                        marriage_date = excluded.marriage_date,
+                        marriage_place = excluded.marriage_place,
+                        record_hash = excluded.record_hash
+                ''', families)
+                cursor.executemany('DELETE FROM family_children WHERE family_id = ?', [(row[0],) for row in families])
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO family_children (family_id, child_id)
+                    SELECT ?, id FROM individuals WHERE id = ?
+                ''', family_children)
+                # build_dates and build_edges use the same connection (write_lock is re-entrant), and build_edges commits everything.
+                self.build_dates([row[0] for row in people], [row[0] for row in families], commit=False)
+                self.build_edges(affected_families)
+            except Exception:
+                conn.rollback()
+                raise
 
     ### RETRIEVING TREE DATA ###
 
     # get_individuals iterates through the individuals table
     # appending each one (including all of their data) to a list
     def get_individuals(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT * FROM individuals")
-        individuals = []
-        for i in cursor:
-            individuals.append(i)
-        return individuals
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT {', '.join(INDIVIDUAL_COLUMNS)} FROM individuals")
+            individuals = []
+            for i in cursor:
+                individuals.append(i)
+            return individuals
 
     # get_families iterates through the families table
     # appending each one (including all data) to a list
     def get_families(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute("SELECT id, father_id, mother_id FROM families")
-        families = []
-        for i in cursor:
-            families.append(i)
-        return families
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id, father_id, mother_id FROM families")
+            families = []
+            for i in cursor:
+                families.append(i)
+            return families
 
     # Gets the parents of a given child by checking the family_children table and selecting their mother_id and father_id
     def get_individual_parents(self, child_id):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            SELECT families.mother_id, families.father_id
-            FROM family_children
-            JOIN families ON family_children.family_id = families.id
-            WHERE family_children.child_id = ?
-        ''', (child_id,))
-        result = cursor.fetchone()
-        if result:
-            return result
-        else:
-            return (None, None)
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT families.mother_id, families.father_id
+                FROM family_children
+                JOIN families ON family_children.family_id = families.id
+                WHERE family_children.child_id = ?
+            ''', (child_id,))
+            result = cursor.fetchone()
+            if result:
+                return result
+            else:
+                return (None, None)
+
+    # Gets every individual along with their parents and partners from the edges table, using two queries for the whole tree
+    # rather than one query per individual.
+    # Each row is the individual's columns, followed by mother_id, father_id and a list of partner IDs.
+    # If a child appears in more than one family, both of their parents are taken from the first family they were added to
+    # which has a parent, so a mother and father from different families are never paired up.
+    # Partners come from every family a person is a parent in, so all marriages are kept.
+    # If a list of IDs is given, only those individuals are returned, and only partners within that list are included.
+    def get_individuals_with_relations(self, ids=None):
+        return list(self.iter_individuals_with_relations(ids))
+
+    # The same as get_individuals_with_relations, but yields each row as it comes off the cursor
+    # instead of building a list, so the whole tree never has to be held in memory at once.
+    # A read connection is held until the generator is finished or closed.
+    def iter_individuals_with_relations(self, ids=None):
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            # The list of IDs is passed to SQLite as one JSON array, which json_each turns back into rows.
+            if ids is None:
+                spouse_filter = ''
+                individual_source = 'individuals'
+                params = ()
+            else:
+                spouse_filter = 'AND person_id IN (SELECT value FROM json_each(:ids)) AND related_id IN (SELECT value FROM json_each(:ids))'
+                # CROSS JOIN makes SQLite look up each ID in individuals, rather than scanning individuals for IDs in the list.
+                individual_source = '(SELECT DISTINCT value AS id FROM json_each(:ids)) AS subset CROSS JOIN individuals ON individuals.id = subset.id'
+                params = {'ids': json.dumps(ids)}
+
+            # Build a map of each person to all of their partners, in the order the families were added.
+            # This is one scan of the edges table's primary key, which is already in this order.
+            cursor.execute(f'''
+                SELECT person_id, related_id
+                FROM edges
+                WHERE kind = 'spouse'
+                {spouse_filter}
+                ORDER BY person_id, position
+            ''', params)
+            partner_map = {}
+            for person_id, partner_id in cursor:
+                partners = partner_map.setdefault(person_id, [])
+                if partner_id not in partners:
+                    partners.append(partner_id)
+
+            # Look up each individual's first family from their 'mother' and 'father' edges, then their mother and father in it.
+            # Both edges for a child in a family have the child's position in that family, so they are matched on position.
+            # Each lookup is a few steps into the edges table's primary key.
+            first_position = '''(SELECT MIN(position) FROM edges WHERE person_id = individuals.id AND kind IN ('father', 'mother'))'''
+            cursor.execute(f'''
+                SELECT {', '.join('individuals.' + column for column in INDIVIDUAL_COLUMNS)},
+                    (SELECT related_id FROM edges WHERE person_id = individuals.id AND kind = 'mother' AND position = {first_position}),
+                    (SELECT related_id FROM edges WHERE person_id = individuals.id AND kind = 'father' AND position = {first_position})
+                FROM {individual_source}
+                ORDER BY individuals.rowid
+            ''', params)
+            for row in cursor:
+                yield row + (partner_map.get(row[0], []),)
+
+    # Yields the ID of every individual in the tree.
+    def iter_individual_ids(self):
+        with self.reader() as conn:
+            for row in conn.execute('SELECT id FROM individuals'):
+                yield row[0]
+
+    # Yields every link between two people which is shown in the tree, as (person_id, related_id) pairs:
+    # each person's mother and father from their first family, and all of their partners (once in each direction).
+    # These are the same links as the mid, fid and pids of get_individuals_with_relations,
+    # but come straight from the edges table's indexes without reading the individuals table.
+    def iter_links(self):
+        with self.reader() as conn:
+            cursor = conn.execute('''
+                SELECT edges.person_id, edges.related_id
+                FROM (
+                    SELECT person_id, MIN(position) AS position
+                    FROM edges
+                    WHERE kind IN ('father', 'mother')
+                    GROUP BY person_id
+                ) AS first_family
+                JOIN edges ON edges.person_id = first_family.person_id AND edges.kind IN ('father', 'mother')
+                    AND edges.position = first_family.position
+                UNION ALL
+                SELECT person_id, related_id FROM edges WHERE kind = 'spouse'
+            ''')
+            for row in cursor:
+                yield row
+
+    # Gets the part of the tree around one person: their ancestors up to {ancestors} generations up,
+    # their descendants up to {descendants} generations down, and the partners of the focus person and their descendants.
+    # Each generation is found with one query over the edges table, walking up through 'father' and 'mother' edges
+    # and down through 'child' edges. Only people who haven't been reached already are walked from,
+    # so people reached along several lines (e.g. cousins who married), or a cycle in a broken file, are only visited once.
+    # Rows are in the same format as get_individuals_with_relations,
+    # with any parents outside of the subtree set to None.
+    # Returns an empty list if the focus person does not exist.
+    def get_subtree(self, focus_id, ancestors, descendants):
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            if cursor.execute('SELECT 1 FROM individuals WHERE id = ?', (focus_id,)).fetchone() is None:
+                return []
+            ancestor_ids = self.walk_generations(cursor, focus_id, ('father', 'mother'), ancestors)
+            descendant_ids = self.walk_generations(cursor, focus_id, ('child',), descendants)
+            cursor.execute('''
+                SELECT related_id FROM edges
+                WHERE person_id IN (SELECT value FROM json_each(?)) AND kind = 'spouse'
+            ''', (json.dumps(descendant_ids),))
+            ids = list(dict.fromkeys(ancestor_ids + descendant_ids + [row[0] for row in cursor]))
+
+        # Remove links to parents that are outside of the subtree, so that every link points to someone who is included.
+        # This is done after the read connection is returned, as get_individuals_with_relations checks out its own.
+        in_subtree = set(ids)
+        subtree = []
+        for individual in self.get_individuals_with_relations(ids):
+            mother_id, father_id = individual[9], individual[10]
+            if mother_id not in in_subtree:
+                mother_id = None
+            if father_id not in in_subtree:
+                father_id = None
+            subtree.append(individual[:9] + (mother_id, father_id, individual[11]))
+        return subtree
+
+    # Walks up to {generations} generations from one person along edges of the given kinds, using the given cursor.
+    # Returns the IDs of everyone reached, starting with the person, with each ID only once.
+    def walk_generations(self, cursor, person_id, kinds, generations):
+        reached = {person_id: None}
+        generation = [person_id]
+        for _ in range(generations):
+            cursor.execute(f'''
+                SELECT DISTINCT related_id FROM edges
+                WHERE person_id IN (SELECT value FROM json_each(?)) AND kind IN ({', '.join('?' * len(kinds))})
+            ''', (json.dumps(generation), *kinds))
+            generation = [row[0] for row in cursor if row[0] not in reached]
+            if not generation:
+                break
+            reached.update(dict.fromkeys(generation))
+        return list(reached)
+
+    # Searches individuals' names, places and occupations with the full-text search index.
+    # Every term must match the start of a word in one of the fields, e.g. ['jo', 'smi'] finds John Smith.
+    # Results are ranked by bm25, with matches in names counting for more than matches in places or occupation,
+    # and only the best {limit} are returned. Each row is in the same format as get_individuals.
+    def search_individuals(self, terms, limit):
+        # Each term is quoted so any characters in it are matched literally rather than read as FTS5 syntax,
+        # and followed by * to make it a prefix search.
+        query = ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT {', '.join('individuals.' + column for column in INDIVIDUAL_COLUMNS)}
+                FROM individuals_search
+                JOIN individuals ON individuals.rowid = individuals_search.rowid
+                WHERE individuals_search MATCH ?
+                ORDER BY bm25(individuals_search, 10.0, 10.0, 2.0, 2.0, 1.0)
+                LIMIT ?
+            ''', (query, limit))
+            return cursor.fetchall()
+
+    # Gets the people who were born, died, married or alive ('born', 'died', 'married' or 'alive') between two day numbers,
+    # sorted by the start of their birth date (people without one last), and only the first {limit} of them.
+    # A person matches if the range of their date overlaps start to end, e.g. ABT 1850 matches a search for 1853.
+    # Every search is an index range scan over one of the date indexes, bounded on both sides: the lower bound is
+    # moved back by the event's longest span from date_spans, and for 'alive' by the longest lifetime.
+    # People without a death date are taken to be alive for dates.LIFESPAN_YEARS after they were born, and people without
+    # a birth date (who are found from their death date) for that long before they died.
+    # Each row has INDIVIDUAL_COLUMNS, followed by the earliest, latest and qualifier of their birth and death dates.
+    def get_timeline(self, event, start, end, limit):
+        columns = ', '.join('individuals.' + column for column in INDIVIDUAL_COLUMNS + [
+            'birth_earliest', 'birth_latest', 'birth_qualifier', 'death_earliest', 'death_latest', 'death_qualifier'])
+        with self.reader() as conn:
+            spans = dict(conn.execute('SELECT event, span FROM date_spans'))
+            params = {
+                'start': start,
+                'end': end,
+                'limit': limit,
+                'lifespan': dates.years_to_days(dates.LIFESPAN_YEARS),
+                'birth_span': spans.get('birth', 0),
+                'death_span': spans.get('death', 0),
+                'marriage_span': spans.get('marriage', 0),
+                'lifetime_span': spans.get('lifetime', 0),
+            }
+            if event in ('born', 'died'):
+                date = 'birth' if event == 'born' else 'death'
+                query = f'''
+                    SELECT {columns} FROM individuals
+                    WHERE {date}_earliest BETWEEN :start - :{date}_span AND :end AND {date}_latest >= :start
+                '''
+            elif event == 'married':
+                query = f'''
+                    SELECT DISTINCT {columns} FROM families
+                    JOIN individuals ON individuals.id IN (families.father_id, families.mother_id)
+                    WHERE families.marriage_earliest BETWEEN :start - :marriage_span AND :end AND families.marriage_latest >= :start
+                '''
+            else:
+                query = f'''
+                    SELECT {columns} FROM individuals
+                    WHERE birth_earliest BETWEEN :start - :lifetime_span AND :end
+                    AND COALESCE(death_latest, birth_latest + :lifespan) >= :start
+                    UNION ALL
+                    SELECT {columns} FROM individuals
+                    WHERE death_earliest BETWEEN :start - :death_span AND :end + :lifespan
+                    AND death_latest >= :start AND death_earliest - :lifespan <= :end AND birth_earliest IS NULL
+                '''
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                SELECT * FROM ({query})
+                ORDER BY birth_earliest IS NULL, birth_earliest, id
+                LIMIT :limit
+            ''', params)
+            return cursor.fetchall()
 
     ##### AUTH DATABASE FUNCTIONS #####
 
     # Create Users Table
     def create_auth_db(self):
-        cursor = self.db_conn.cursor()
-        # Create the users table, storing username, email, pass_hash
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                email TEXT,
-                pass_hash TEXT
-            )  
-        ''')
-        # Create the trees table, which just stores all of the currently existing trees
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS trees (
-                tree_name TEXT PRIMARY KEY
-            )
-        ''')
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            # Create the users table, storing username, email, pass_hash
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    email TEXT,
+                    pass_hash TEXT
+                )  
+            ''')
+            # Create the trees table, which just stores all of the currently existing trees
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS trees (
+                    tree_name TEXT PRIMARY KEY
+                )
+            ''')
 
-        # Create the user_trees table, which is a linked table that maps which trees a user has access to
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_trees (
+            # Create the user_trees table, which is a linked table that maps which trees a user has access to
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_trees (
+                    username TEXT NOT NULL,
+                    tree_name TEXT NOT NULL,
+                    PRIMARY KEY (username, tree_name),
+                    FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE,
+                    FOREIGN KEY(tree_name) REFERENCES trees(tree_name) ON DELETE CASCADE
+                )
+            ''')
+
+            # Create the sessions table, which tracks all current session tokens
+            cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY,
                 username TEXT NOT NULL,
-                tree_name TEXT NOT NULL,
-                PRIMARY KEY (username, tree_name),
-                FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE,
-                FOREIGN KEY(tree_name) REFERENCES trees(tree_name) ON DELETE CASCADE
-            )
-        ''')
+                expires_at TEXT,
+                FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE
+                )
+            ''')
 
-        # Create the sessions table, which tracks all current session tokens
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS sessions (
-            token TEXT PRIMARY KEY,
-            username TEXT NOT NULL,
-            expires_at TEXT,
-            FOREIGN KEY(username) REFERENCES users(username) ON DELETE CASCADE
-            )
-        ''')
+            # This line exists to create a tree for the usernames field of the sessions table.
+            # This increases the performance of looking up based on username as looking up through a B-Tree has a time complexity of O(log n),
+            # compared to a linear search of O(n)
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)')
 
-        # This line exists to create a tree for the usernames field of the sessions table.
-        # This increases the performance of looking up based on username as looking up through a B-Tree has a time complexity of O(log n),
-        # compared to a linear search of O(n)
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_username ON sessions(username)')
-        self.db_conn.commit()
+            # A single row counting the sessions which have been revoked (by logging out or deleting a user).
+            # Each API worker process caches sessions, and clears its cache when this changes (see auth.check_session_cache).
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS revocations (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    count INTEGER NOT NULL
+                )
+            ''')
+            cursor.execute('INSERT OR IGNORE INTO revocations (id, count) VALUES (1, 0)')
+            conn.commit()
 
     # Creates a new user based on the username, email and password hash (salt embedded in hash)
     def new_user(self, username, email, pass_hash):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
         
-        INSERT INTO users (
-            username, email, pass_hash)
-        VALUES (?, ?, ?)
-        ''',(
-            username,
-            email,
-            pass_hash
-        ))
-        self.db_conn.commit()
+            INSERT INTO users (
+                username, email, pass_hash)
+            VALUES (?, ?, ?)
+            ''',(
+                username,
+                email,
+                pass_hash
+            ))
+            conn.commit()
     # Gets the trees a specific username has access to by selecting the trees field in the users table.
     # Takes this output, splits the string into a list and adds each entry to a list,
     # before returning the list
     # If result is blank, it returns an empty string
     def get_user_trees(self, username):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-        SELECT tree_name
-        FROM user_trees
-        WHERE username = ?
-        ''', (username,))
-        result = cursor.fetchall()
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT tree_name
+            FROM user_trees
+            WHERE username = ?
+            ''', (username,))
+            result = cursor.fetchall()
 
-        trees_list = []
-        for row in result:
-            trees_list.append(row[0])
+            trees_list = []
+            for row in result:
+                trees_list.append(row[0])
 
-        return trees_list
+            return trees_list
 
     # Adds a trees to a user by inserting the tree into the trees table,
     # and then inserting the tree into the user_trees table along with their username.
     def add_tree_to_user(self, username, tree_name):
-        cursor = self.db_conn.cursor()
+        with self.writer() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('''
-            INSERT OR IGNORE INTO trees (tree_name)
-            VALUES (?)
-        ''', (tree_name,))
+            cursor.execute('''
+                INSERT OR IGNORE INTO trees (tree_name)
+                VALUES (?)
+            ''', (tree_name,))
 
-        cursor.execute('''
-            INSERT OR IGNORE INTO user_trees (username, tree_name)
-            VALUES (?,?)
-        ''', (username, tree_name))
+            cursor.execute('''
+                INSERT OR IGNORE INTO user_trees (username, tree_name)
+                VALUES (?,?)
+            ''', (username, tree_name))
 
-        self.db_conn.commit()
+            conn.commit()
 
     # Deletes a tree from the user_trees table, unlinking the tree from the user.
     def delete_user_tree(self, username, tree_name):
-        cursor = self.db_conn.cursor()
+        with self.writer() as conn:
+            cursor = conn.cursor()
 
-        cursor.execute('''
-            DELETE FROM user_trees
-            WHERE username = ? AND tree_name = ?
-        ''', (username, tree_name))
+            cursor.execute('''
+                DELETE FROM user_trees
+                WHERE username = ? AND tree_name = ?
+            ''', (username, tree_name))
 
-        self.db_conn.commit()
+            conn.commit()
 
     # Removes a given username from the DB (currently not used, exists in API)
+    # This deletes all of the user's sessions, so the revocation count goes up in the same transaction.
     def delete_user(self, username):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            DELETE FROM users
-                WHERE username = ?
-        ''',(
-            username,
-        ))
-        self.db_conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                DELETE FROM users
+                    WHERE username = ?
+            ''',(
+                username,
+            ))
+            cursor.execute('UPDATE revocations SET count = count + 1 WHERE id = 1')
+            conn.commit()
 
     # Takes a username and returns their pass_hash
     # This is used in auth.py to verify a user's password.
     def verify_user(self, username):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-            SELECT pass_hash
-            FROM users
-            WHERE username = ?
-        ''', (username,))
-        result = cursor.fetchone()
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT pass_hash
+                FROM users
+                WHERE username = ?
+            ''', (username,))
+            result = cursor.fetchone()
 
-        if result:
-            return result[0]
-        else:
-            return None
+            if result:
+                return result[0]
+            else:
+                return None
     # SESSIONS MANAGEMENT
 
     # Takes a username, a generated token, and the expiry timestamp, commits it to the DB
     def save_session(self, username, token, expires_at):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-        INSERT OR REPLACE INTO sessions (
-            token, username, expires_at)
-        VALUES (?, ?, ?)
-        ''',(
-            token,
-            username,
-            expires_at
-        ))
-        self.db_conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            INSERT OR REPLACE INTO sessions (
+                token, username, expires_at)
+            VALUES (?, ?, ?)
+            ''',(
+                token,
+                username,
+                expires_at
+            ))
+            conn.commit()
 
     # Gets the session token of a user, used to check a user is authenticated when making requests.
     def get_session(self, token):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-        SELECT token, username, expires_at
-        FROM sessions
-        WHERE token = ?
-        ''', (token,))
-        return cursor.fetchone()
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            SELECT token, username, expires_at
+            FROM sessions
+            WHERE token = ?
+            ''', (token,))
+            return cursor.fetchone()
 
     # Deletes a session, which is called when a user attempts to use an invalid session, or logs out.
-    def delete_session(self, token):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-        DELETE FROM sessions
-        WHERE token = ?
-        ''', (token,))
-        self.db_conn.commit()
+    # If revoked is True and the session existed, the revocation count goes up in the same transaction,
+    # so other processes stop trusting the session from their caches.
+    def delete_session(self, token, revoked=True):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            DELETE FROM sessions
+            WHERE token = ?
+            ''', (token,))
+            if revoked and cursor.rowcount:
+                cursor.execute('UPDATE revocations SET count = count + 1 WHERE id = 1')
+            conn.commit()
+
+    # Gets the number of sessions which have been revoked, which only changes when a session is revoked.
+    def get_revocation_count(self):
+        with self.reader() as conn:
+            return conn.execute('SELECT count FROM revocations WHERE id = 1').fetchone()[0]
+
+    # Deletes every session which expired before the given time.
+    # Called regularly by auth's session sweeper, so expired sessions don't wait for a restart to be removed.
+    def delete_expired_sessions(self, now):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            DELETE FROM sessions
+            WHERE expires_at < ?
+            ''', (now,))
+            conn.commit()
+            return cursor.rowcount
 
     # Clears all sessions when the program restarts.
     # This also serves as a way to clear expired sessions.
     def clear_sessions(self):
-        cursor = self.db_conn.cursor()
-        cursor.execute('''
-        DELETE FROM sessions
-        ''')
-        self.db_conn.commit()
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            DELETE FROM sessions
+            ''')
+            conn.commit()
+
+    # IMPORT JOBS
+    # Import jobs are kept in their own DB, so that every API worker process sees the same jobs,
+    # and the frequent progress updates don't count as changes to the auth DB.
+
+    # Creates the jobs table. Each job has its status, phase, progress and error, and the times it started and finished.
+    # The unique index only covers jobs which haven't finished, so only one import of each tree can run at a time across every worker.
+    def create_jobs_db(self):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    username TEXT NOT NULL,
+                    tree TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    phase TEXT NOT NULL,
+                    records INTEGER NOT NULL DEFAULT 0,
+                    rate REAL NOT NULL DEFAULT 0,
+                    error TEXT,
+                    started_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_running_tree ON jobs(tree) WHERE finished_at IS NULL')
+            # The SHA-256 hash of the file each tree was last imported from, so uploading the same file again can skip the import.
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS imports (
+                    tree TEXT PRIMARY KEY,
+                    sha256 TEXT NOT NULL,
+                    imported_at REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            conn.commit()
+
+    # Adds a running job in the given phase, and deletes jobs which finished before retention_cutoff.
+    # Returns False if the tree already has a job running (in any process), or True if the job was added.
+    def new_job(self, job_id, username, tree, phase, started_at, retention_cutoff):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute('DELETE FROM jobs WHERE finished_at < ?', (retention_cutoff,))
+                cursor.execute('''
+                    INSERT INTO jobs (job_id, username, tree, status, phase, started_at)
+                    VALUES (?, ?, ?, 'running', ?, ?)
+                ''', (job_id, username, tree, phase, started_at))
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return False
+            conn.commit()
+            return True
+
+    # Moves a job out of the 'saving' phase into the given phase, if fewer than max_running jobs (in any process)
+    # have already left the 'saving' phase and not finished. Jobs which are still being uploaded don't count.
+    # Returns True if the job was moved, or False if there are already max_running.
+    # The transaction is started with BEGIN IMMEDIATE, so two processes can't both count the jobs and then both start one.
+    def start_job(self, job_id, phase, max_running):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            running = cursor.execute(
+                "SELECT COUNT(*) FROM jobs WHERE finished_at IS NULL AND phase != 'saving'"
+            ).fetchone()[0]
+            if running >= max_running:
+                conn.rollback()
+                return False
+            cursor.execute('UPDATE jobs SET phase = ? WHERE job_id = ?', (phase, job_id))
+            conn.commit()
+            return True
+
+    # Sets the phase of a job and, if records isn't None, the number of records processed and the rate in records per second.
+    def update_job(self, job_id, phase, records, now):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs
+                SET phase = :phase,
+                    records = COALESCE(:records, records),
+                    rate = CASE WHEN :now > started_at THEN ROUND(COALESCE(:records, records) / (:now - started_at), 1) ELSE rate END
+                WHERE job_id = :job_id
+            ''', {'job_id': job_id, 'phase': phase, 'records': records, 'now': now})
+            conn.commit()
 
-    # Commit to the DB and close the connection.
+    # Marks a job as finished, with its status ('done' or 'failed') as its phase, and an error message if it failed.
+    def finish_job(self, job_id, status, error, finished_at):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs
+                SET status = ?, phase = ?, error = ?, finished_at = ?
+                WHERE job_id = ?
+            ''', (status, status, error, finished_at, job_id))
+            conn.commit()
+
+    # Gets a job's row as a dictionary of its columns, or None if it doesn't exist.
+    def get_job(self, job_id):
+        with self.reader() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM jobs WHERE job_id = ?', (job_id,))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            return dict(zip([column[0] for column in cursor.description], row))
+
+    # Records the hash of the file a tree was imported from, replacing the hash from its last import.
+    def record_import(self, tree, sha256, imported_at):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO imports (tree, sha256, imported_at) VALUES (?, ?, ?)
+                ON CONFLICT (tree) DO UPDATE SET sha256 = excluded.sha256, imported_at = excluded.imported_at
+            ''', (tree, sha256, imported_at))
+            conn.commit()
+
+    # Gets the hash of the file a tree was last imported from, or None if it hasn't been imported.
+    def get_import_hash(self, tree):
+        with self.reader() as conn:
+            row = conn.execute('SELECT sha256 FROM imports WHERE tree = ?', (tree,)).fetchone()
+            return row[0] if row else None
+
+    # Counts the jobs which haven't finished yet.
+    def count_running_jobs(self):
+        with self.reader() as conn:
+            return conn.execute('SELECT COUNT(*) FROM jobs WHERE finished_at IS NULL').fetchone()[0]
+
+    # Marks every job which hasn't finished as failed. Called when the server starts,
+    # as any import that was running when it stopped will never finish, and would stop its tree from being imported again.
+    def fail_unfinished_jobs(self, error, finished_at):
+        with self.writer() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs
+                SET status = 'failed', phase = 'failed', error = ?, finished_at = ?
+                WHERE finished_at IS NULL
+            ''', (error, finished_at))
+            conn.commit()
+
+    # Copy the whole DB into a new file at backup_path, using SQLite's backup API
+    # so the copy is consistent even if another connection is writing to the DB.
+    def backup(self, backup_path):
+        backup_conn = sqlite3.connect(backup_path)
+        try:
+            with self.reader() as conn:
+                conn.backup(backup_conn)
+        finally:
+            backup_conn.close()
+
+    # Commit to the DB and close the connections.
     def close(self):
-        self.db_conn.commit()
-        self.db_conn.close()
\ No newline at end of file
+        with self.write_lock:
+            self.db_conn.commit()
+            self.db_conn.close()
+        for _ in range(self.readers):
+            self.read_pool.get().close()
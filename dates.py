@@ -0,0 +1,153 @@
+import datetime
+import functools
+import re
+
+# Gedcom dates are text like "3 MAR 1920", "ABT 1850", "BEF 1916" or "BET 1801 AND 1805".
+# parse_date turns them into a range of day numbers (the earliest and latest days the date could be) and a qualifier,
+# so dates can be sorted and searched by range in SQL. Day numbers are proleptic Gregorian ordinals, where 1 is 1 JAN 0001
+# (the same as datetime.date.toordinal), so dates in the Julian calendar are converted to the same scale.
+#
+# Qualifiers:
+# - exact: a day, month or year, e.g. 1850 is every day of 1850
+# - about, calculated, estimated: ABT, CAL and EST dates, widened by ABOUT_YEARS on either side
+# - before, after: BEF and AFT dates, which cover BEFORE_YEARS before or AFTER_YEARS after the date
+# - between: BET ... AND ..., from the start of the first date to the end of the second
+# - period: FROM ... TO ..., with a missing end covering AFTER_YEARS and a missing start covering BEFORE_YEARS
+# - interpreted: INT dates, using the date and ignoring the phrase after it
+# Dates which can't be parsed (phrases, years before 1, or other calendars) have no range and no qualifier.
+
+# How many years ABT, CAL and EST dates are widened by, on each side.
+ABOUT_YEARS = 5
+# How many years before or after a date BEF and AFT dates cover, like the matching settings in Gramps.
+BEFORE_YEARS = 50
+AFTER_YEARS = 50
+# The longest anyone is assumed to live, used for people who are missing a birth or death date.
+LIFESPAN_YEARS = 110
+
+DAYS_PER_YEAR = 365.2425
+
+MONTHS = {'JAN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAY': 5, 'JUN': 6, 'JUL': 7, 'AUG': 8, 'SEP': 9, 'OCT': 10, 'NOV': 11, 'DEC': 12}
+# The difference between a Julian day number and a day number.
+JULIAN_DAY_OFFSET = 1721425
+QUALIFIERS = {'ABT': 'about', 'CAL': 'calculated', 'EST': 'estimated'}
+
+# A single date, with an optional calendar escape, day and month, e.g. @#DJULIAN@ 3 MAR 1720.
+# The year can be a dual year like 1750/51, for dates in the part of the year which was counted as the previous year at the time.
+DATE_PATTERN = re.compile(r'(?:@#D(?P<calendar>[A-Z ]+)@ )?(?:(?:(?P<day>\d{1,2}) )?(?P<month>[A-Z]{3}) )?(?P<year>\d{1,4})(?:/(?P<dual>\d{1,2}))?')
+
+# Turn a number of years into a number of days.
+def years_to_days(years):
+    return round(years * DAYS_PER_YEAR)
+
+# Get the day number of a day in the Gregorian or Julian calendar, or None if it isn't a real day.
+def day_number(calendar, year, month, day):
+    if calendar == 'GREGORIAN':
+        try:
+            return datetime.date(year, month, day).toordinal()
+        except ValueError:
+            return None
+    if day > (29 if month == 2 and year % 4 == 0 else (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)[month - 1]):
+        return None
+    # Julian day number of a Julian calendar date.
+    a = (14 - month) // 12
+    y = year + 4800 - a
+    m = month + 12 * a - 3
+    return day + (153 * m + 2) // 5 + 365 * y + y // 4 - 32083 - JULIAN_DAY_OFFSET
+
+# Get the first and last day numbers of a single date, e.g. "MAR 1920" gives the first and last days of March 1920.
+# Returns None if the date can't be parsed.
+def parse_single_date(text):
+    match = DATE_PATTERN.fullmatch(text.strip())
+    if match is None:
+        return None
+    calendar = (match['calendar'] or 'GREGORIAN').strip()
+    if calendar not in ('GREGORIAN', 'JULIAN'):
+        return None
+    year = int(match['year'])
+    if match['dual']:
+        year += 1
+    if year < 1:
+        return None
+    if match['month'] is None:
+        first_month, last_month = 1, 12
+    elif match['month'] in MONTHS:
+        first_month = last_month = MONTHS[match['month']]
+    else:
+        return None
+    if match['day'] is not None:
+        if match['month'] is None:
+            return None
+        start = end = day_number(calendar, year, first_month, int(match['day']))
+    else:
+        start = day_number(calendar, year, first_month, 1)
+        # The last day of the month is the day before the first day of the next month.
+        next_year, next_month = (year + 1, 1) if last_month == 12 else (year, last_month + 1)
+        end = day_number(calendar, next_year, next_month, 1)
+        end = end - 1 if end is not None else None
+    if start is None or end is None:
+        return None
+    return start, end
+
+# Parse a gedcom date into (earliest, latest, qualifier), or (None, None, None) if it can't be parsed.
+# The same dates come up many times in a tree, so the results are cached.
+@functools.lru_cache(maxsize=65536)
+def parse_date(text):
+    if not text:
+        return None, None, None
+    text = ' '.join(text.upper().split())
+    keyword, _, rest = text.partition(' ')
+    if keyword == 'BET' and ' AND ' in rest:
+        first, _, second = rest.partition(' AND ')
+        start, end = parse_single_date(first), parse_single_date(second)
+        if start is None or end is None:
+            return None, None, None
+        return min(start[0], end[0]), max(start[1], end[1]), 'between'
+    if keyword == 'FROM':
+        first, _, second = rest.partition(' TO ')
+        start = parse_single_date(first)
+        end = parse_single_date(second) if second else None
+        if start is None or (second and end is None):
+            return None, None, None
+        if end is None:
+            return start[0], start[1] + years_to_days(AFTER_YEARS), 'period'
+        return min(start[0], end[0]), max(start[1], end[1]), 'period'
+    if keyword == 'TO':
+        end = parse_single_date(rest)
+        if end is None:
+            return None, None, None
+        return end[0] - years_to_days(BEFORE_YEARS), end[1], 'period'
+    if keyword in QUALIFIERS:
+        date = parse_single_date(rest)
+        if date is None:
+            return None, None, None
+        return date[0] - years_to_days(ABOUT_YEARS), date[1] + years_to_days(ABOUT_YEARS), QUALIFIERS[keyword]
+    if keyword == 'BEF':
+        date = parse_single_date(rest)
+        if date is None:
+            return None, None, None
+        return date[0] - years_to_days(BEFORE_YEARS), date[0] - 1, 'before'
+    if keyword == 'AFT':
+        date = parse_single_date(rest)
+        if date is None:
+            return None, None, None
+        return date[1] + 1, date[1] + years_to_days(AFTER_YEARS), 'after'
+    if keyword == 'INT':
+        date = parse_single_date(rest.split('(', 1)[0])
+        if date is None:
+            return None, None, None
+        return date[0], date[1], 'interpreted'
+    date = parse_single_date(text)
+    if date is None:
+        return None, None, None
+    return date[0], date[1], 'exact'
+
+# Get one part of a parsed date: 0 for the earliest day, 1 for the latest day, or 2 for the qualifier.
+# This is registered as the gedcom_date SQL function, which fills in the date columns of a tree DB.
+def parse_date_part(text, part):
+    return parse_date(text)[part]
+
+# Turn a day number back into an ISO date (e.g. 1850-01-01), or None if there isn't one.
+def day_to_iso(day):
+    if day is None or not 1 <= day <= datetime.date.max.toordinal():
+        return None
+    return datetime.date.fromordinal(day).isoformat()
@@ -1,21 +1,160 @@
 from gedcom.parser import Parser
 from gedcom.element.individual import IndividualElement
 from gedcom.element.family import FamilyElement
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing
+import hashlib
 import os
 import re
+import time
 from database import Database
+import sql2json
+import charsets
+import metrics
 from config import get_cfg
 
 #
 cfg = get_cfg()
 DB_DIR = cfg['db_dir']
+# Imports are built in this directory, then moved into DB_DIR once they are complete.
+# Tree names can't start with a dot, so nothing in it can be mistaken for a tree's files.
+IMPORT_DIR = os.path.join(DB_DIR, '.importing')
 
-# Use python-gedcom to parse the gedcom file and compile a list of all elements
+# Number of rows buffered by add_data before they are written to the database.
+BATCH_SIZE = 10000
+# The number of processes used to parse each gedcom file. If it is 0, the CPU cores are shared between the most imports
+# which can run at once (import_workers), so imports running together don't start more processes than there are cores.
+PARSE_WORKERS = int(cfg['parse_workers']) or max(1, (os.cpu_count() or 1) // int(cfg['import_workers']))
+# Files smaller than this (in bytes) are parsed in this process, as starting the worker processes would take longer than parsing them.
+PARALLEL_MIN_SIZE = 4 * 1024 * 1024
+# The size (in bytes) of each chunk of the file given to a worker process.
+CHUNK_SIZE = 1024 * 1024
+
+# Read the gedcom file one level-0 record at a time (e.g. an INDI or FAM and all of its sub-tags),
+# yielding the raw lines of each record as bytes.
+# Only the lines of the current record are held in memory.
+# If start and end are given, only the records between those byte offsets are read. Both must be at the start of a level-0 line.
+def read_records(gedcom_path, start=0, end=None):
+    with open(gedcom_path, 'rb') as gedcom_stream:
+        gedcom_stream.seek(start)
+        position = start
+        record = []
+        for line in gedcom_stream:
+            if end is not None and position >= end:
+                break
+            position += len(line)
+            # A line starting with level 0 begins the next record, so the current one is finished.
+            if record and line.startswith(b'0 '):
+                yield record
+                record = []
+            record.append(line)
+        if record:
+            yield record
+
+# Hash the raw lines of a record, so a record can be checked for changes without parsing it.
+def record_hash(record):
+    return hashlib.blake2b(b''.join(record), digest_size=16).hexdigest()
+
+# Get the pointer and tag from the first line of a record, e.g. (b'@I12@', b'INDI') from b'0 @I12@ INDI'.
+# Returns (None, None) for records without a pointer, such as the header.
+def record_pointer(record):
+    match = re.match(rb'\s*0\s+(@[^@]+@)\s+(\w+)', record[0])
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2)
+
+# Use python-gedcom to parse the gedcom file, yielding each level-0 element as soon as its record has been read,
+# along with the hash of its record.
+# The same parser is reused for every record, and parse() clears out the previous record each time,
+# so memory use depends on the size of one record rather than the size of the file.
 def parse_file(gedcom_path):
     parser = Parser()
-    parser.parse_file(gedcom_path, False)
-    elements = parser.get_element_list()
-    return elements
+    for record in read_records(gedcom_path):
+        parser.parse(record, False)
+        hash = record_hash(record)
+        for element in parser.get_root_child_elements():
+            yield element, hash
+
+# Split the gedcom file into chunks of about CHUNK_SIZE bytes, returning the (start, end) byte offsets of each.
+# Each chunk ends just before a level-0 line, the same place read_records splits records,
+# so reading every chunk gives exactly the same records as reading the whole file.
+# Rather than reading the whole file, this seeks to each CHUNK_SIZE boundary and reads forward to the next level-0 line.
+def chunk_bounds(gedcom_path):
+    size = os.path.getsize(gedcom_path)
+    bounds = []
+    start = 0
+    with open(gedcom_path, 'rb') as gedcom_stream:
+        while start < size:
+            gedcom_stream.seek(start + CHUNK_SIZE)
+            # Skip the rest of the line the boundary landed in, then find the next line which starts a record.
+            gedcom_stream.readline()
+            end = gedcom_stream.tell()
+            for line in iter(gedcom_stream.readline, b''):
+                if line.startswith(b'0 '):
+                    break
+                end += len(line)
+            end = min(end, size)
+            bounds.append((start, end))
+            start = end
+    return bounds
+
+# Parse the records between two byte offsets of the gedcom file, returning lists of their rows: (people, families, family_children).
+# This runs in a worker process for parse_chunks, so it only takes and returns things that can be pickled.
+def parse_chunk(gedcom_path, start, end):
+    people = []
+    families = []
+    family_children = []
+    parser = Parser()
+    for record in read_records(gedcom_path, start, end):
+        parser.parse(record, False)
+        hash = record_hash(record)
+        for element in parser.get_root_child_elements():
+            add_element_rows(element, hash, people, families, family_children)
+    return people, families, family_children
+
+# Parse the gedcom file in a pool of worker processes, one chunk from chunk_bounds per task,
+# yielding each chunk's rows in the same order as the file, for add_data.
+# At most two chunks per worker are parsed ahead of the one being written, so the rows of the whole file are never held at once.
+# The workers are started with 'spawn', as forking the API process while its other threads hold locks isn't safe.
+def parse_chunks(gedcom_path, workers):
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        pending = deque()
+        for start, end in chunk_bounds(gedcom_path):
+            pending.append(pool.submit(parse_chunk, gedcom_path, start, end))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # If the import fails part way through, don't wait for the chunks which haven't started.
+        pool.shutdown(cancel_futures=True)
+
+# Turn the elements and record hashes from parse_file into batches of rows for add_data,
+# each with up to BATCH_SIZE rows between its (people, families, family_children) lists.
+def element_batches(elements):
+    people = []
+    families = []
+    family_children = []
+    for element, hash in elements:
+        add_element_rows(element, hash, people, families, family_children)
+        if len(people) + len(families) + len(family_children) >= BATCH_SIZE:
+            yield people, families, family_children
+            people = []
+            families = []
+            family_children = []
+    if people or families or family_children:
+        yield people, families, family_children
+
+# Parse the gedcom file into batches of rows for add_data.
+# Large files are split into chunks which are parsed by PARSE_WORKERS processes at once, and smaller files are parsed here.
+# Both give the same rows in the same order.
+def parse_batches(gedcom_path):
+    workers = PARSE_WORKERS
+    if workers > 1 and os.path.getsize(gedcom_path) >= PARALLEL_MIN_SIZE:
+        return parse_chunks(gedcom_path, workers)
+    return element_batches(parse_file(gedcom_path))
 
 # Function to normalise IDs, removing the surrounding @ symbols and the I/F prefix.
 def normalise_id(id):
@@ -27,104 +166,270 @@ def normalise_id(id):
     nid = re.sub(r'^[A-Za-z]+', '', nid)
     return nid if nid != "" else None
 
-# Function to iterate through all elements, collecting their data and adding it to the database.
-def add_data(elements, db):
-        # Iterate through all elements
-        for element in elements:
-            # Check if the element is an Individual (person), then process the data as such
-            if isinstance(element, IndividualElement):
-                id = normalise_id(element.get_pointer())
-
-                # Get gender if available, set it to Male or Female
-                if element.get_gender() == "M":
-                    gender = "male"
-                elif element.get_gender() == "F":
-                    gender = "female"
-                else:
-                    gender = ""
-
-                name_data = element.get_name()
-
-                # Check if name_data contains anything.
-                # If it does, set the first_name and last_name from it,
-                # else leave it blank
-                if name_data:
-                    first_name, last_name = name_data
-                else:
-                    first_name, last_name = "", ""
-
-                # Retrieve other data
-                birth_date = element.get_birth_date()
-                birth_place = element.get_birth_place()
-                death_date = element.get_death_date()
-                death_place = element.get_death_place()
-                occupation = element.get_occupation()
-
-                # Add all of this data to the database.
-                db.add_person_data(id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation)
-            # Check if the element is a Family
-            elif isinstance(element, FamilyElement):
-                # Initially set values to None/Empty
-                mother_id = None
-                father_id = None
-                marriage_date = ""
-                marriage_place = ""
-                children = []
-
-                try:
-                    # Try to set mother_id and father_id
-                    # re.sub exists to strip text before the ID
-                    mother_id = re.sub(r'^.*?@', '@', str(element.get_wives()[0]))
-                    father_id = re.sub(r'^.*?@', '@', str(element.get_husbands()[0]))
-
-                    # Iterate through the children in the family,
-                    # cut the child name out of the string,
-                    # retrieve their ID and normalise id,
-                    # then append it to the children list
-                    for child in element.get_children():
-                        child_str = str(child).strip()
-                        child_id = re.sub(r'^.*?@', '@', child_str)
-                        normalised_child_id = normalise_id(child_id)
-                        if normalised_child_id:
-                            children.append(normalised_child_id)
-                # If there's an IndexError (no data), allow it to pass and use the empty results.
-                except IndexError:
-                    pass
-
-                # Iterate through the child elements (sub-elements, not elements of children) to get marriage information.
-                for child in element.get_child_elements():
-                     tag = child.get_tag()
-                     if tag == 'MARR':
-                         for fam_data in child.get_child_elements():
-                             if fam_data.get_tag() == 'DATE':
-                                 marriage_date = fam_data.get_value() or ""
-                             elif fam_data.get_tag() == 'PLAC':
-                                 marriage_place = fam_data.get_value() or ""
-
-                # If mother_id or father_id are blank, set None
-                if father_id == "":
-                    father_id = None
-                if mother_id == "":
-                    mother_id = None
-
-                # Normalise the IDs (remove '@' prefix and suffix)
-                id = normalise_id(element.get_pointer())
-                mother_id = normalise_id(mother_id)
-                father_id = normalise_id(father_id)
-
-                # Add family data and the children to the database
-                db.add_family_data(id, father_id, mother_id, marriage_date, marriage_place)
-                for child_id in children:
-                    db.add_family_child(id, child_id)
+# Build the row for an individual, in the same column order as the individuals table.
+def get_person_row(element):
+    id = normalise_id(element.get_pointer())
+
+    # Get gender if available, set it to Male or Female
+    if element.get_gender() == "M":
+        gender = "male"
+    elif element.get_gender() == "F":
+        gender = "female"
+    else:
+        gender = ""
+
+    name_data = element.get_name()
+
+    # Check if name_data contains anything.
+    # If it does, set the first_name and last_name from it,
+    # else leave it blank
+    if name_data:
+        first_name, last_name = name_data
+    else:
+        first_name, last_name = "", ""
+
+    # Retrieve other data
+    birth_date = element.get_birth_date()
+    birth_place = element.get_birth_place()
+    death_date = element.get_death_date()
+    death_place = element.get_death_place()
+    occupation = element.get_occupation()
+
+    return (id, first_name, last_name, gender, birth_date, birth_place, death_date, death_place, occupation)
+
+# Build the row for a family, in the same column order as the families table,
+# and the list of the IDs of the family's children.
+def get_family_row(element):
+    # Initially set values to None/Empty
+    mother_id = None
+    father_id = None
+    marriage_date = ""
+    marriage_place = ""
+    children = []
+
+    try:
+        # Try to set mother_id and father_id
+        # re.sub exists to strip text before the ID
+        mother_id = re.sub(r'^.*?@', '@', str(element.get_wives()[0]))
+        father_id = re.sub(r'^.*?@', '@', str(element.get_husbands()[0]))
+
+        # Iterate through the children in the family,
+        # cut the child name out of the string,
+        # retrieve their ID and normalise id,
+        # then append it to the children list
+        for child in element.get_children():
+            child_str = str(child).strip()
+            child_id = re.sub(r'^.*?@', '@', child_str)
+            normalised_child_id = normalise_id(child_id)
+            if normalised_child_id:
+                children.append(normalised_child_id)
+    # If there's an IndexError (no data), allow it to pass and use the empty results.
+    except IndexError:
+        pass
+
+    # Iterate through the child elements (sub-elements, not elements of children) to get marriage information.
+    for child in element.get_child_elements():
+         tag = child.get_tag()
+         if tag == 'MARR':
+             for fam_data in child.get_child_elements():
+                 if fam_data.get_tag() == 'DATE':
+                     marriage_date = fam_data.get_value() or ""
+                 elif fam_data.get_tag() == 'PLAC':
+                     marriage_place = fam_data.get_value() or ""
+
+    # If mother_id or father_id are blank, set None
+    if father_id == "":
+        father_id = None
+    if mother_id == "":
+        mother_id = None
+
+    # Normalise the IDs (remove '@' prefix and suffix)
+    id = normalise_id(element.get_pointer())
+    mother_id = normalise_id(mother_id)
+    father_id = normalise_id(father_id)
+
+    return (id, father_id, mother_id, marriage_date, marriage_place), children
+
+# Add the rows for an element and the hash of its record to the lists of rows:
+# an Individual (person) adds their row to people, and a Family adds its row to families and a row for each child to family_children.
+# Any other element (e.g. the header) is skipped.
+def add_element_rows(element, hash, people, families, family_children):
+    if isinstance(element, IndividualElement):
+        people.append(get_person_row(element) + (hash,))
+    elif isinstance(element, FamilyElement):
+        family, children = get_family_row(element)
+        families.append(family + (hash,))
+        for child_id in children:
+            family_children.append((family[0], child_id))
+
+# Function to add batches of rows from parse_batches to the database, where each batch is a tuple of (people, families, family_children) lists.
+# Each batch is written as it arrives, inside a single transaction which is committed once all batches have been added.
+# Returns the number of rows written.
+# If a progress function is given, it is called with the phase ('loading') and the number of records read after each batch.
+@metrics.timed('ged2sql.add_data')
+def add_data(batches, db, progress=None):
+    rows = 0
+    records = 0
+    db.begin_bulk_load()
+    # If anything fails part way through (e.g. a record that can't be parsed),
+    # roll back the whole load rather than leaving part of the file in the database.
+    try:
+        for people, families, family_children in batches:
+            # Write people first so that families can refer to them.
+            db.add_people(people)
+            db.add_families(families)
+            db.stage_family_children(family_children)
+            rows += len(people) + len(families) + len(family_children)
+            records += len(people) + len(families)
+            if progress:
+                progress("loading", records)
+    except Exception:
+        db.abort_bulk_load()
+        raise
+    db.end_bulk_load()
+    return rows
+
+# Function to bring an existing tree's DB in line with a new version of its gedcom file.
+# Each INDI and FAM record is hashed, and only the records whose hash is different from the one stored against their ID are parsed.
+# IDs in the DB which are no longer in the file are deleted. Everything is written in one transaction by apply_changes,
+# so the cost of re-uploading a file depends on how much of it has changed rather than its size.
+# Only the first record with each ID is used, as with add_data.
+# Returns the number of rows added, changed or deleted.
+# If a progress function is given, it is called with the phase ('comparing' or 'loading') and the number of records read.
+@metrics.timed('ged2sql.update_data')
+def update_data(gedcom_path, db, progress=None):
+    existing = {b'INDI': db.get_record_hashes('individuals'), b'FAM': db.get_record_hashes('families')}
+    seen = {b'INDI': set(), b'FAM': set()}
+    people = []
+    families = []
+    family_children = []
+    records = 0
+    parser = Parser()
+
+    # Parse a changed record and buffer its rows.
+    def add_record(record, hash):
+        parser.parse(record, False)
+        for element in parser.get_root_child_elements():
+            add_element_rows(element, hash, people, families, family_children)
+
+    for record in read_records(gedcom_path):
+        pointer, tag = record_pointer(record)
+        if tag not in existing:
+            continue
+        id = normalise_id(pointer.decode('utf-8', 'replace'))
+        if id is None or id in seen[tag]:
+            continue
+        seen[tag].add(id)
+        records += 1
+        hash = record_hash(record)
+        if existing[tag].get(id) != hash:
+            add_record(record, hash)
+        if progress and records % BATCH_SIZE == 0:
+            progress("comparing", records)
+
+    unchanged = records - len(people) - len(families)
+
+    # A family which hasn't changed may refer to someone who is new in this version of the file,
+    # e.g. if they were missing from the last version. Those links were left out when the family was added,
+    # so the file is read again (without parsing) to find and re-add any unchanged families which refer to new people.
+    added_people = seen[b'INDI'] - existing[b'INDI'].keys()
+    if added_people:
+        checked_families = {family[0] for family in families}
+        for record in read_records(gedcom_path):
+            pointer, tag = record_pointer(record)
+            if tag != b'FAM':
+                continue
+            id = normalise_id(pointer.decode('utf-8', 'replace'))
+            if id is None or id in checked_families:
+                continue
+            checked_families.add(id)
+            references = {normalise_id(reference.decode('utf-8', 'replace')) for reference in re.findall(rb'@[^@]+@', b''.join(record[1:]))}
+            if not references.isdisjoint(added_people):
+                add_record(record, record_hash(record))
+
+    deleted_people = [id for id in existing[b'INDI'] if id not in seen[b'INDI']]
+    deleted_families = [id for id in existing[b'FAM'] if id not in seen[b'FAM']]
+    if progress:
+        progress("loading", records)
+    db.apply_changes(people, families, family_children, deleted_people, deleted_families)
+
+    written = len(people) + len(families)
+    added = len(added_people) + len(seen[b'FAM'] - existing[b'FAM'].keys())
+    deleted = len(deleted_people) + len(deleted_families)
+    print(f"Incremental import: {added} records added, {written - added} changed, {deleted} deleted, {unchanged} unchanged")
+    return written + deleted
 
 # Function called by API to process uploaded gedcom file.
-# Parse the file, create DB, create tables in DB, add data to DB, then close and commit.
-def run(gedcom_path):
-    elements = parse_file(gedcom_path)
-    os.makedirs(DB_DIR, exist_ok=True)
+# Create DB, create tables in DB, then parse the file and add its data to DB as it is read, then close and commit.
+# Once the data is in the DB, the indexes are created and analysed by upgrade_family_db, and the JSON for the tree is built and cached.
+# If the tree's DB already has data in it (the file is being re-uploaded), only the changes are written, using update_data.
+# The import is built in a temporary DB file (starting as a copy of the tree's DB if it has one), which is renamed over the tree's DB
+# once it is complete. Requests keep reading the old version of the tree until then, and if the import fails
+# the temporary file is deleted, so the tree's DB is never left half-written.
+# The number of rows written per second is printed so that imports can be compared.
+# If a progress function is given, it is called with the current phase ('parsing', 'comparing', 'loading' or 'indexing')
+# and the number of records read so far (if it has changed), so that the API can report how the import is going.
+# The tree is named after the gedcom file, unless a tree name is given (e.g. when importing an upload from its temporary file).
+@metrics.timed('ged2sql.run')
+def run(gedcom_path, progress=None, tree=None):
+    if progress:
+        progress("parsing", 0)
+    os.makedirs(IMPORT_DIR, exist_ok=True)
     gedcom_name = os.path.basename(gedcom_path)
-    db_path = os.path.join(DB_DIR, gedcom_name.rsplit('.', 1)[0] + '.db')
-    db = Database(db_path)
-    db.create_family_db()
-    add_data(elements, db)
-    db.close()
\ No newline at end of file
+    if tree is None:
+        tree = gedcom_name.rsplit('.', 1)[0]
+    db_path = os.path.join(DB_DIR, tree + '.db')
+    # Only one import of a tree runs at a time, so any temporary files left for this tree are from an import that was interrupted.
+    tmp_path = os.path.join(IMPORT_DIR, tree + '.db')
+    for path in (tmp_path, tmp_path + '-journal'):
+        if os.path.exists(path):
+            os.remove(path)
+    start = time.perf_counter()
+    try:
+        # Files in other character sets (e.g. ANSEL or UTF-16) are converted to UTF-8 first, as the parser reads them as UTF-8.
+        with metrics.stage('ged2sql.charset'):
+            charsets.ensure_utf8(gedcom_path)
+        if os.path.exists(db_path):
+            live_db = Database(db_path)
+            try:
+                with metrics.stage('ged2sql.backup'):
+                    live_db.backup(tmp_path)
+            finally:
+                live_db.close()
+        db = Database(tmp_path)
+        try:
+            db.create_family_db()
+            if db.has_tree_data():
+                # The DB is upgraded first, so that it has the record hashes, search index and edges which update_data needs.
+                db.upgrade_family_db()
+                rows = update_data(gedcom_path, db, progress)
+            else:
+                rows = add_data(parse_batches(gedcom_path), db, progress)
+                if progress:
+                    progress("indexing")
+                # A new DB has its search index, edges and dates built as part of the upgrade, otherwise they are rebuilt for the new data.
+                with metrics.stage('ged2sql.indexing'):
+                    if not db.upgrade_family_db():
+                        db.build_search_index()
+                        db.build_edges()
+                        db.build_dates()
+        finally:
+            db.close()
+        os.replace(tmp_path, db_path)
+    except BaseException:
+        for path in (tmp_path, tmp_path + '-journal'):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    elapsed = time.perf_counter() - start
+    print(f"Imported {rows} rows from {gedcom_name} in {elapsed:.2f}s ({rows / max(elapsed, 1e-9):.0f} rows/s)")
+    # Replace the cached JSON for the old version of the tree in every format (the website asks for the columnar one),
+    # so that the new version can be served straight away.
+    # The new DB is already live by now, so if building the cache fails the import has still succeeded:
+    # the error is only printed, and the JSON is built when the tree is next requested instead.
+    try:
+        sql2json.invalidate_cache(tree)
+        for format in sql2json.FORMATS:
+            sql2json.build_cache(tree, format)
+    except Exception as e:
+        print(f"Error when building the cached JSON for {tree}: {e}")
\ No newline at end of file
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from gedcom import parser
+from config import get_cfg
+from database import Database
+import ged2sql
+import metrics
+import auth
+import secrets
+import sqlite3
+import time
+import os
+
+# Get config dictionary and set constants used for import jobs.
+cfg = get_cfg()
+# The most imports which can be queued or running at once across every API worker process, any more are turned away until one finishes.
+# Uploads which are still being saved don't count.
+IMPORT_WORKERS = int(cfg['import_workers'])
+# How long (in seconds) a finished job's status is kept for, so it can still be polled.
+JOB_RETENTION = float(cfg['job_retention'])
+USER_DIR = str(cfg['user_data_dir'])
+
+# Imports run in this pool of threads, so the upload request can return straight away
+# and the event loop is free to handle other requests while the file is imported.
+import_pool = ThreadPoolExecutor(max_workers=IMPORT_WORKERS, thread_name_prefix="import")
+
+# The status of every job is kept in the jobs DB rather than in memory, as the API can run as several worker processes:
+# the status of a job can be polled from any worker, and only one import per tree runs at a time across all of them.
+# It is opened in WAL mode, as the API reads job statuses while the import threads update them.
+os.makedirs(USER_DIR, exist_ok=True)
+db = Database(f'{USER_DIR}/jobs.db', wal=True, name='jobs')
+
+# Counts the imports which have finished, labelled with whether they were 'done' or 'failed'.
+IMPORTS_FINISHED = metrics.Counter('imports_finished_total', 'Imports which have finished, by status.', labels=('status',))
+
+##### JOB MANAGEMENT #####
+# Raised when an import can't be started because IMPORT_WORKERS imports are already queued or running.
+class TooManyImports(Exception):
+    pass
+
+# Create the jobs table (if it doesn't exist), and mark any imports which were running when the server stopped as failed.
+# This runs once when the server starts (from main.py), rather than in each API worker,
+# as a worker starting up can't tell whether another worker's import is still running.
+def setup():
+    db.create_jobs_db()
+    db.fail_unfinished_jobs("The server restarted before the import finished. Please upload the file again.", time.time())
+
+# Create a job for importing a tree, starting in the 'saving' phase while the upload is saved.
+# Jobs which finished more than JOB_RETENTION seconds ago are removed at the same time.
+# Returns the job ID, or None if the tree is already being imported.
+def create_job(username, tree):
+    job_id = secrets.token_urlsafe(16)
+    now = time.time()
+    if not db.new_job(job_id, username, tree, "saving", now, now - JOB_RETENTION):
+        return None
+    return job_id
+
+# Update the phase and number of records processed for a job, and work out its throughput in records per second.
+# If records is None, the number of records is left as it was.
+def update_job(job_id, phase, records=None):
+    db.update_job(job_id, phase, records, time.time())
+
+# Mark a job as finished, either 'done' or 'failed' with an error message, and allow the tree to be imported again.
+def finish_job(job_id, status, error=None):
+    db.finish_job(job_id, status, error, time.time())
+    IMPORTS_FINISHED.inc(status=status)
+
+# Get a job's status, if it belongs to the given user.
+# Returns None if the job does not exist or belongs to someone else.
+def get_job(job_id, username):
+    job = db.get_job(job_id)
+    if job is None or job["username"] != username:
+        return None
+    return {
+        "job": job["job_id"],
+        "tree": job["tree"],
+        "status": job["status"],
+        "phase": job["phase"],
+        "records": job["records"],
+        "rate": job["rate"],
+        "error": job["error"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+##### IMPORTING #####
+# Check whether a tree was last imported from a file with the given SHA-256 hash, in which case importing it again would change nothing.
+# The tree's DB must also still exist, in case it has been deleted since it was imported.
+def already_imported(tree, sha256):
+    return db.get_import_hash(tree) == sha256 and os.path.exists(os.path.join(ged2sql.DB_DIR, tree + '.db'))
+
+# Queue the import of an uploaded gedcom file, whose SHA-256 hash is recorded for the tree once it has been imported.
+# The file is imported from upload_path, and only moved to gedcom_path (replacing the tree's last gedcom file) if the import works.
+# The job waits in the 'queued' phase until a worker is free.
+# Raises TooManyImports if IMPORT_WORKERS imports are already queued or running, counting the imports of every API worker process.
+def start_import(job_id, upload_path, gedcom_path, sha256):
+    if not db.start_job(job_id, "queued", IMPORT_WORKERS):
+        raise TooManyImports(f"{IMPORT_WORKERS} imports are already running")
+    import_pool.submit(run_import, job_id, upload_path, gedcom_path, sha256)
+
+# Runs on an import thread: parse the uploaded file into the tree's DB using ged2sql, reporting progress to the job,
+# then move it over the tree's gedcom file, add the tree to the user's trees and record the hash of the file it was imported from.
+# Some known errors are given their own messages. If anything fails, the uploaded file is deleted and the job is marked as failed,
+# and the tree's DB and gedcom file are left as they were.
+def run_import(job_id, upload_path, gedcom_path, sha256):
+    job = db.get_job(job_id)
+    username = job["username"]
+    tree = job["tree"]
+    try:
+        ged2sql.run(upload_path, progress=lambda phase, records=None: update_job(job_id, phase, records), tree=tree)
+        os.replace(upload_path, gedcom_path)
+        auth.db.add_tree_to_user(username, tree)
+        db.record_import(tree, sha256, time.time())
+    except sqlite3.DatabaseError as e:
+        message = f'Database file is corrupted. Please delete/move it and try again. {e}'
+        print(f"SQL.DatabaseError: {e}")
+    except (parser.GedcomFormatViolationError, AttributeError) as e:
+        message = f'Gedcom Parse failed. Is this a valid Gedcom file? {e}'
+        print(f"GedcomFormatViolationError: {e}")
+    except UnicodeDecodeError as e:
+        message = f'The file is not a readable format. Please re-generate the file or try a different file. {e}'
+        print(f'UnicodeDecodeError: {e}')
+    except Exception as e:
+        message = f'An unexpected error occurred: {str(e)}'
+        print(f"Unexpected Error: {e}")
+    else:
+        finish_job(job_id, "done")
+        return
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+    finish_job(job_id, "failed", message)
@@ -1,6 +1,9 @@
 import uvicorn
 from config import get_cfg
 import subprocess
+import argparse
+import auth
+import jobs
 import os
 import shutil
 
@@ -9,20 +12,43 @@ cfg = get_cfg()
 PORT = int(cfg['api_port'])
 USER_DIR = str(cfg['user_data_dir'])
 HOST_IP = cfg['host_ip']
+# The number of API worker processes in production mode. If it is 0, one worker is started for each CPU core.
+API_WORKERS = int(cfg['api_workers'])
 
 # Main function
+# By default, this runs Astro's dev server and one API process which reloads when the code changes.
+# With --production, the website is built, and the API runs as several worker processes so requests can be handled on more than one core.
+# The workers serve the built website too, with the API under /api (see server.py), so no Node server runs in production.
+# The workers share all of their state (users, sessions, jobs and trees) through the SQLite files in USER_DIR.
 def main():
+    arg_parser = argparse.ArgumentParser(description="Run the family tree viewer")
+    arg_parser.add_argument("--production", action="store_true", help="build the website and run the API with several worker processes")
+    args = arg_parser.parse_args()
 
     # Run website server
     npm = shutil.which("npm")
-    astro_process = subprocess.Popen(
-        [npm, "run", "dev"],
-        cwd="website"
-    )
+    if args.production:
+        subprocess.run([npm, "run", "build"], cwd="website", check=True)
+    else:
+        astro_process = subprocess.Popen(
+            [npm, "run", "dev"],
+            cwd="website"
+        )
     os.makedirs(USER_DIR, exist_ok=True)
     print(f"Using Directory: {USER_DIR}")
-    # Run the API on localhost on the configured configured port
-    uvicorn.run("api:api", host=HOST_IP, port=PORT, reload=True)
+    # Create the DB tables, log out all users and fail any imports which were interrupted.
+    # This runs here, once, rather than in each API worker as it starts.
+    auth.setup()
+    jobs.setup()
+    if args.production:
+        workers = API_WORKERS or os.cpu_count() or 1
+        print(f"Starting {workers} API workers")
+        # Run the website and API on the configured host and port, with uvicorn supervising the worker processes.
+        print(f"Serving the website at http://{HOST_IP}:{PORT}")
+        uvicorn.run("server:app", host=HOST_IP, port=PORT, workers=workers)
+    else:
+        # Run the API on localhost on the configured configured port
+        uvicorn.run("api:api", host=HOST_IP, port=PORT, reload=True)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
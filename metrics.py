@@ -0,0 +1,187 @@
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+# Metrics about how long requests, import and render stages, and SQL queries take,
+# which are shown in Prometheus' text format by the /api/metrics endpoint.
+# There are three types of metric:
+# - Histogram: counts how many observations (e.g. request durations) fall into each bucket, along with their sum and count
+# - Counter: a number which only goes up, e.g. the number of queries run
+# - Gauge: a number which can go up and down, read from a function whenever the metrics are shown, e.g. the size of a queue
+# Each metric can have labels (e.g. route="/tree"), and keeps a separate value for each combination of labels.
+
+# Every metric that has been created, in the order they are shown.
+registry = []
+
+# Default histogram buckets (in seconds), from 1ms up to 30s.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Escape a label value, as backslashes, quotes and newlines have special meanings in the text format.
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Format a set of labels, e.g. {method="GET",route="/tree"}, or an empty string if there are none.
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{escape(value)}"' for name, value in extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Maps each combination of label values to [bucket counts, sum, count].
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    # Record one observation, e.g. the duration of a request, against the given labels.
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    # Time the code inside a with block and record how long it took.
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    # Get the lines of text for this histogram. Bucket counts are cumulative, as the format expects.
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            values = [(key, list(entry[0]), entry[1], entry[2]) for key, entry in self.values.items()]
+        for key, bucket_counts, total, count in sorted(values):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", bound)])} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", "+Inf")])} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    # Add amount to the counter for the given labels.
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, '') for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.append(f'{self.name}{format_labels(self.labels, key)} {value}')
+        return lines
+
+class Gauge:
+    # function is called each time the metrics are shown, and returns the current value.
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.function()}']
+
+# Get every metric in Prometheus' text format.
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+# The content type of the text format, which Prometheus checks for.
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+##### METRICS #####
+REQUEST_DURATION = Histogram(
+    'http_request_duration_seconds',
+    'Time taken to handle HTTP requests, until the whole response has been sent.',
+    labels=('method', 'route', 'status'),
+)
+STAGE_DURATION = Histogram(
+    'stage_duration_seconds',
+    'Time taken by each stage of importing and rendering trees.',
+    labels=('stage',),
+    buckets=(0.0001, 0.0005) + DURATION_BUCKETS + (60.0, 120.0, 300.0),
+)
+QUERY_DURATION = Histogram(
+    'sql_query_duration_seconds',
+    'Time taken to execute SQL statements, up to the first row of the result.',
+    labels=('db', 'statement'),
+    buckets=(0.00005, 0.0001, 0.0005) + DURATION_BUCKETS,
+)
+
+# Time a stage, e.g. with metrics.stage('ged2sql.indexing'):
+def stage(name):
+    return STAGE_DURATION.time(stage=name)
+
+# Decorator which times every call to a function as a stage, e.g. @metrics.timed('sql2json.jsonify')
+# This shouldn't be used on generators, as it would only time creating the generator.
+def timed(name):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+##### MIDDLEWARE #####
+# ASGI middleware which records the duration of every HTTP request in REQUEST_DURATION.
+# Requests are labelled with the path of the route that handled them (e.g. /tree/subtree) rather than the URL,
+# so query strings and IDs in the URL don't create a new set of values for every request.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        # Watch for the start of the response to get its status code.
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router adds the route it matched to the scope, which is missing for paths that don't exist.
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            REQUEST_DURATION.observe(time.perf_counter() - start, method=scope['method'], route=route, status=status)
@@ -0,0 +1,14 @@
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+import api
+
+# The app run by the API workers in production mode (see main.py).
+# Astro's preview server isn't meant for production and doesn't proxy /api to the API like the dev server does,
+# so instead the built website in website/dist is served by the same workers as the API, with the API under /api.
+# Pages are served from their index.html (e.g. /home from website/dist/home/index.html), and the API's cookies,
+# which are set for every path, are sent with both.
+WEBSITE_DIR = "website/dist"
+
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+app.mount("/api", api.api)
+app.mount("/", StaticFiles(directory=WEBSITE_DIR, html=True), name="website")
@@ -1,50 +1,240 @@
 from database import Database
 from config import get_cfg
+import metrics
+import dates
+import threading
+import tempfile
+import json
+import gzip
+import re
 import os
 
-# Get db_dir from the config and set it as global variable
+# orjson encodes the tree straight to bytes several times faster than the json module.
+# If it isn't installed, encode_json falls back to the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Get db_dir and min_component_size from the config and set them as global variables
 cfg = get_cfg()
 DB_DIR = cfg['db_dir']
+# Components of the tree with fewer people than this are not displayed.
+MIN_COMPONENT_SIZE = int(cfg['min_component_size'])
+# The number of read-only connections kept open to each tree's DB.
+TREE_DB_READERS = int(cfg['tree_db_readers'])
+
+# Open Database for each tree, reused between requests rather than opening and closing the file every time.
+# Each one is stored with the inode of the file it opened, so that if the file is deleted or replaced,
+# the new file is opened instead. The old Database is dropped rather than closed, as a request may still be using it,
+# and its connections are closed once nothing refers to it.
+tree_dbs = {}
+tree_dbs_lock = threading.Lock()
 
-# Get the data for each individual from the database
+# Get the data for each individual from the database,
+# including their parents and a list of their partners.
+# This is built by the database in two queries, rather than looking up each individual's parents one at a time.
+@metrics.timed('sql2json.get_individuals_data')
 def get_individuals_data(db):
-    # Get individuals and families from DB into a list
-    individuals = db.get_individuals()
-    families = db.get_families()
-
-    # Build a map of all partners from the mother_id and father_id in each family
-    partner_map = {}
-    for family in families:
-        family_id, father_id, mother_id = family
-        if father_id and mother_id:
-            partner_map[father_id] = mother_id
-            partner_map[mother_id] = father_id
-
-    # Build a list of individuals
-    raw_individuals = []
-    # Iterate through individuals,
-    # get parents from DB function,
-    # get partners from the partner_map,
-    # then add their data to the list
-    for individual in individuals:
-        id = individual[0]
-        mother_id, father_id = db.get_individual_parents(id)
-        partner_id = partner_map.get(id)
-        raw_individuals.append(individual + (mother_id, father_id, partner_id))
-    return raw_individuals
+    return db.get_individuals_with_relations()
+
+# Convert one individual's row into a labeled dictionary
+def jsonify_individual(i):
+    # Copy their list of partners, which is empty if they have none
+    pids = list(i[11])
+    return {
+        "id": i[0],
+        "Name": f"{i[1]} {i[2]}",
+        "gender": i[3],
+        "Birth Date": i[4],
+        "Birth Place": i[5],
+        "Death Date": i[6],
+        "Death Place": i[7],
+        "Occupation": i[8],
+        "mid": i[9],
+        "fid": i[10],
+        "pids": pids
+    }
 
 # Convert the list into a json list
+@metrics.timed('sql2json.jsonify')
 def jsonify(individuals):
-    jsonified = []
-    # Iterate through individuals to add data to the new list
-    for i in individuals:
-        # Check if they have a partner, if not then set pids to be an empty list
-        if i[11] is not None:
-            pids = [i[11]]
-        else:
-            pids = []
-        # Add all of the data from the individual to a labeled section, then append it to the jsonified list
-        entry = {
+    return [jsonify_individual(i) for i in individuals]
+
+# Sometimes, gedcom files contain people which have no connections,
+# or small groups of people which aren't connected to the rest of the tree.
+# These cause clutter when rendered, so this function filters them out.
+# Everyone linked by a parent or partner connection is grouped into the same component,
+# and components with fewer than min_component_size people are removed.
+# With the default of 2, only people with no connections at all are removed.
+@metrics.timed('sql2json.remove_isolated_individuals')
+def remove_isolated_individuals(individuals, min_component_size=2):
+    # Link everyone to their mother, father and partners.
+    links = (
+        (individual['id'], related_id)
+        for individual in individuals
+        for related_id in [individual['mid'], individual['fid']] + individual['pids']
+        if related_id is not None
+    )
+    connected = get_connected_ids((individual['id'] for individual in individuals), links, min_component_size)
+    return [individual for individual in individuals if individual['id'] in connected]
+
+# Get the set of IDs of everyone in a component with at least min_component_size people.
+# ids is every person's ID, and links is (id, related_id) pairs of people who are connected.
+# Both only need to be iterated once, so they can be generators straight from the DB.
+@metrics.timed('sql2json.get_connected_ids')
+def get_connected_ids(ids, links, min_component_size=2):
+    # Each ID maps to another ID in the same component, following these leads to the component's root.
+    # sizes holds the number of people in each component, stored against its root.
+    roots = {}
+    sizes = {}
+
+    # Find the root of the component an ID is in, adding it as a component of its own if it is new.
+    # Each ID on the way is pointed further up, which keeps later lookups short.
+    def find(id):
+        if id not in roots:
+            roots[id] = id
+            sizes[id] = 1
+            return id
+        while roots[id] != id:
+            roots[id] = roots[roots[id]]
+            id = roots[id]
+        return id
+
+    # Join the components of two connected IDs, attaching the smaller component to the larger.
+    def join(id, other_id):
+        root = find(id)
+        other_root = find(other_id)
+        if root == other_root:
+            return
+        if sizes[root] < sizes[other_root]:
+            root, other_root = other_root, root
+        roots[other_root] = root
+        sizes[root] += sizes.pop(other_root)
+
+    # Add everyone as a component of their own, then join each linked pair.
+    # Someone who is a parent is joined when their child is, so parents are never filtered.
+    ids = list(ids)
+    for id in ids:
+        find(id)
+    for id, related_id in links:
+        join(id, related_id)
+
+    # Keep everyone whose component is big enough to be displayed.
+    return {id for id in ids if sizes[find(id)] >= min_component_size}
+
+# Encode a value as compact JSON bytes, using orjson if it is installed.
+def encode_json(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+##### TREE DATABASES #####
+# Get the open Database for a tree, opening it if it isn't open yet or if its file has changed.
+# Returns None if the tree's DB file does not exist.
+@metrics.timed('sql2json.get_tree_db')
+def get_tree_db(tree):
+    # Form the path to the database file by concatenating
+    # the db_dir from config, the provided tree name, and appending .db
+    db_path = DB_DIR + "/" + tree + ".db"
+    try:
+        inode = os.stat(db_path).st_ino
+    except FileNotFoundError:
+        close_tree_db(tree)
+        return None
+
+    with tree_dbs_lock:
+        open_db = tree_dbs.get(tree)
+        if open_db is not None and open_db[1] == inode:
+            return open_db[0]
+        # Trees imported by older versions may be missing indexes, so upgrade the DB before it is used.
+        db = Database(db_path, readers=TREE_DB_READERS)
+        db.upgrade_family_db()
+        tree_dbs[tree] = (db, inode)
+        return db
+
+# Drop the open Database for a tree, if there is one. Called when a tree's DB file is deleted.
+def close_tree_db(tree):
+    with tree_dbs_lock:
+        tree_dbs.pop(tree, None)
+
+# This function is called by the API
+# to create the json response from a tree.
+@metrics.timed('sql2json.run')
+def run(tree):
+    # Get the open DB for the tree. If the file does not exist, return None,
+    # which the API interprets as 404 not found
+    db = get_tree_db(tree)
+    if db is None:
+        return None
+
+    # Run the above functions to collect
+    # and filter the data before returning the JSON list to the API.
+    raw_individuals = get_individuals_data(db)
+    jsonified = jsonify(raw_individuals)
+    output = remove_isolated_individuals(jsonified, MIN_COMPONENT_SIZE)
+    return output
+
+# This function is called by the API to create the json response for part of a tree,
+# made up of the focus person, their ancestors and descendants up to the given number of generations, and partners.
+# Returns None if the tree does not exist, or an empty list if the focus person does not exist.
+@metrics.timed('sql2json.run_subtree')
+def run_subtree(tree, focus_id, ancestors, descendants):
+    db = get_tree_db(tree)
+    if db is None:
+        return None
+
+    # Everyone in a subtree is connected to the focus person, so there is nobody to filter out.
+    raw_individuals = db.get_subtree(focus_id, ancestors, descendants)
+    output = jsonify(raw_individuals)
+    return output
+
+# This function is called by the API to search a tree for people whose names, places or occupation start with the words in query.
+# Returns up to {limit} people, best matches first, with the same fields as jsonify except for mid, fid and pids.
+# Returns None if the tree does not exist.
+@metrics.timed('sql2json.run_search')
+def run_search(tree, query, limit):
+    db = get_tree_db(tree)
+    if db is None:
+        return None
+
+    # Only letters and numbers are searched for, so punctuation in the query is ignored.
+    terms = re.findall(r'\w+', query)
+    if not terms:
+        return []
+    output = []
+    for i in db.search_individuals(terms, limit):
+        output.append({
+            "id": i[0],
+            "Name": f"{i[1]} {i[2]}",
+            "gender": i[3],
+            "Birth Date": i[4],
+            "Birth Place": i[5],
+            "Death Date": i[6],
+            "Death Place": i[7],
+            "Occupation": i[8]
+        })
+    return output
+
+# Turn a parsed date into a dictionary of its earliest and latest days (as ISO dates) and its qualifier, or None if it wasn't parsed.
+def date_range(earliest, latest, qualifier):
+    if earliest is None:
+        return None
+    return {"earliest": dates.day_to_iso(earliest), "latest": dates.day_to_iso(latest), "qualifier": qualifier}
+
+# This function is called by the API to find the people in a tree who were born, died, married or alive between start and end,
+# which are day numbers (see dates.py). Returns up to {limit} people, sorted by birth date,
+# with the same fields as run_search and the ranges their birth and death dates were parsed into.
+# Returns None if the tree does not exist.
+@metrics.timed('sql2json.run_timeline')
+def run_timeline(tree, event, start, end, limit):
+    db = get_tree_db(tree)
+    if db is None:
+        return None
+
+    output = []
+    for i in db.get_timeline(event, start, end, limit):
+        output.append({
             "id": i[0],
             "Name": f"{i[1]} {i[2]}",
             "gender": i[3],
@@ -53,76 +243,195 @@ def jsonify(individuals):
             "Death Date": i[6],
             "Death Place": i[7],
             "Occupation": i[8],
-            "mid": i[9],
-            "fid": i[10],
-            "pids": pids
-        }
-        jsonified.append(entry)
-    return jsonified
-
-# Sometimes, gedcom files contain people which have no connections.
-# These should not be displayed as they have no connections, and cause clutter when rendered.
-# This function exists to filter them out.
-def remove_isolated_individuals(individuals):
-    # Builds a list of parents
-    # If someone ends up in this list then they have
-    # at least one child,so should not be filtered
-    parent_ids = []
+            "Birth Range": date_range(i[9], i[10], i[11]),
+            "Death Range": date_range(i[12], i[13], i[14]),
+        })
+    return output
+
+##### COLUMNAR FORMAT #####
+# In the columnar format, a tree is sent as one array per field rather than one dictionary per person,
+# so key names like "Birth Place" are only sent once instead of once per person.
+# It looks like this:
+# {
+#     "format": "columnar",
+#     "length": number of people,
+#     "columns": {"id": [...], "Name": [...], "gender": [...], ...},
+#     "tables": {"gender": [...], "Birth Place": [...], ...},
+#     "refs": [...],
+#     "pids_count": [...]
+# }
+# - Fields in COLUMNAR_TABLE_FIELDS repeat a lot (e.g. place names), so their column holds positions in a table of strings,
+#   and each string is only sent once.
+# - mid, fid and pids hold positions in the id column, or null for no parent.
+#   The rare IDs which aren't in the tree (e.g. a partner with no record) are added to refs, and are referred to
+#   by positions after the end of the id column.
+# - The pids column is every person's partners one after the other, and pids_count is how many partners each person has.
+# The decoder in website/src/components/DisplayTree.astro turns this back into the same list as jsonify.
+COLUMNAR_TABLE_FIELDS = ["gender", "Birth Date", "Birth Place", "Death Date", "Death Place", "Occupation"]
+COLUMNAR_TEXT_FIELDS = ["id", "Name"]
+
+# Convert a list of people from jsonify into the columnar format.
+@metrics.timed('sql2json.columnarise')
+def columnarise(individuals):
+    columns = {field: [] for field in COLUMNAR_TEXT_FIELDS + COLUMNAR_TABLE_FIELDS + ["mid", "fid", "pids"]}
+    tables = {field: [] for field in COLUMNAR_TABLE_FIELDS}
+    # Maps each string in a table to its position, so each lookup is O(1).
+    table_positions = {field: {} for field in COLUMNAR_TABLE_FIELDS}
+    pids_count = []
+
+    # Every ID in the tree is given its position first, so references to people later in the list can be looked up.
+    positions = {}
     for individual in individuals:
-        if individual['mid'] is not None:
-            if individual['mid'] not in parent_ids:
-                parent_ids.append(individual['mid'])
+        positions.setdefault(individual['id'], len(positions))
+    refs = []
 
-        if individual['fid'] is not None:
-            if individual['fid'] not in parent_ids:
-                parent_ids.append(individual['fid'])
+    # Get the position of a referenced ID, adding it to refs if it isn't in the tree.
+    def ref(id):
+        if id is None:
+            return None
+        if id not in positions:
+            positions[id] = len(positions)
+            refs.append(id)
+        return positions[id]
 
-    # Builds a list of all people who has a parent,
-    # has a partner or is a parent.
-    filtered = []
     for individual in individuals:
-        has_parents = False
-        has_partners = False
-        is_parent = False
-        # Checks their mother_id or father_id field is not empty.
-        # If one of them is not, they are a child!
-        if individual['mid'] is not None or individual['fid'] is not None:
-            has_parents = True
-
-        # Checks if their list of Partner IDs is not empty.
-        # If it isn't, they have a partner connection
-        if len(individual['pids']) > 0:
-            has_partners = True
-
-        # Checks if their ID is in parent_ids,
-        # if it is, they have a child.
-        if individual['id'] in parent_ids:
-            is_parent = True
-
-        # If any of the above checks return true,
-        # they have at least one connection so are okay to display.
-        if has_parents or has_partners or is_parent:
-            filtered.append(individual)
-
-    return filtered
+        for field in COLUMNAR_TEXT_FIELDS:
+            columns[field].append(individual[field])
+        for field in COLUMNAR_TABLE_FIELDS:
+            value = individual[field]
+            position = table_positions[field].get(value)
+            if position is None:
+                position = table_positions[field][value] = len(tables[field])
+                tables[field].append(value)
+            columns[field].append(position)
+        columns['mid'].append(ref(individual['mid']))
+        columns['fid'].append(ref(individual['fid']))
+        columns['pids'].extend(ref(pid) for pid in individual['pids'])
+        pids_count.append(len(individual['pids']))
 
-# This function is called by the API
-# to create the json response from a tree.
-def run(tree):
-    # Form the path to the database file by concatenating
-    # the db_dir from config, the provided tree name, and appending .db
-    db_path = DB_DIR + "/" + tree + ".db"
-    # If the file does not exist, return None,
-    # which the API interprets as 404 not found
-    if not os.path.isfile(db_path):
+    return {
+        "format": "columnar",
+        "length": len(columns['id']),
+        "columns": columns,
+        "tables": tables,
+        "refs": refs,
+        "pids_count": pids_count
+    }
+
+##### CACHED TREE JSON #####
+# A tree only changes when it is uploaded or deleted, so the JSON for each tree is built once
+# and stored next to its database file, rather than being rebuilt on every request.
+# Each format the tree can be sent in has its own cache file.
+
+# Form the path to the cached JSON for a tree, e.g. {db_dir}/{tree}.json or {db_dir}/{tree}.columnar.json
+def cache_path(tree, format="json"):
+    return DB_DIR + "/" + tree + FORMATS[format][0]
+
+# The size (in bytes) of each chunk of JSON yielded by stream_json, large enough that
+# the response isn't sent in lots of tiny writes, and small enough that memory use stays flat.
+CHUNK_SIZE = 64 * 1024
+
+# Form the path to the gzipped copy of the cached JSON, which is sent to browsers that accept gzip
+# so large trees aren't compressed again on every request.
+def gzip_cache_path(tree, format="json"):
+    return cache_path(tree, format) + ".gz"
+
+# Encode a tree as a JSON list, yielding it in chunks of bytes as the rows come off the DB cursor.
+# The rows are read twice: once for just the relations, to work out which people are isolated,
+# then again to encode everyone who is kept. Only the set of kept IDs is held in memory, never the whole list.
+def stream_json(db):
+    # The first pass only needs the links between people, which come from the edges table without reading everyone's details.
+    connected = get_connected_ids(db.iter_individual_ids(), db.iter_links(), MIN_COMPONENT_SIZE)
+    chunk = bytearray(b'[')
+    first = True
+    for i in db.iter_individuals_with_relations():
+        entry = jsonify_individual(i)
+        if entry['id'] not in connected:
+            continue
+        if not first:
+            chunk += b','
+        first = False
+        chunk += encode_json(entry)
+        if len(chunk) >= CHUNK_SIZE:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += b']'
+    yield bytes(chunk)
+
+# Encode a tree in the columnar format. Every column has to be complete before it can be sent,
+# so unlike stream_json this is built in memory and yielded as one chunk.
+def stream_columnar(db):
+    yield encode_json(columnarise(remove_isolated_individuals(jsonify(db.iter_individuals_with_relations()), MIN_COMPONENT_SIZE)))
+
+# The formats a tree can be sent in, mapped to the ending of their cache file and the function which encodes them.
+FORMATS = {
+    "json": (".json", stream_json),
+    "columnar": (".columnar.json", stream_columnar),
+}
+
+# Encode a tree in the given format, writing it to the cache files as it goes and yielding each chunk,
+# so the API can send the tree to the browser while the cache is built.
+# db must be the tree's current Database from get_tree_db.
+# Both files are written to temporary files first and then renamed into place,
+# so a request never reads a half-written file. If the generator is stopped early
+# (e.g. the browser disconnects), the temporary files are removed and the cache is left as it was.
+def write_cache(db, tree, format="json"):
+    fd, tmp_path = tempfile.mkstemp(dir=DB_DIR, suffix=".tmp")
+    gzip_fd, tmp_gzip_path = tempfile.mkstemp(dir=DB_DIR, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as cache_file, os.fdopen(gzip_fd, 'wb') as gzip_file:
+            with gzip.GzipFile(fileobj=gzip_file, mode='wb', compresslevel=6, mtime=0) as compressed:
+                for chunk in FORMATS[format][1](db):
+                    cache_file.write(chunk)
+                    compressed.write(chunk)
+                    yield chunk
+        # If the tree's DB was replaced by an import while this was being written, it is out of date,
+        # so it is thrown away rather than replacing the cache built from the new DB.
+        if get_tree_db(tree) is not db:
+            os.remove(tmp_path)
+            os.remove(tmp_gzip_path)
+            return
+        # The gzipped copy is moved first, so the plain JSON (which the ETag comes from) is never newer than it.
+        os.replace(tmp_gzip_path, gzip_cache_path(tree, format))
+        os.replace(tmp_path, cache_path(tree, format))
+    except BaseException:
+        for path in (tmp_path, tmp_gzip_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+
+# Build the JSON for a tree in the given format and store it in the cache files, replacing any older copy.
+# Returns the path to the cache file, or None if the tree does not exist.
+@metrics.timed('sql2json.build_cache')
+def build_cache(tree, format="json"):
+    db = get_tree_db(tree)
+    if db is None:
         return None
+    for _ in write_cache(db, tree, format):
+        pass
+    return cache_path(tree, format)
 
-    # Initialise a connection to the DB,
-    # then run the above functions to collect
-    # and filter the data before returning the JSON list to the API.
-    db = Database(db_path)
-    raw_individuals = get_individuals_data(db)
-    jsonified = jsonify(raw_individuals)
-    output = remove_isolated_individuals(jsonified)
-    db.close()
-    return output
\ No newline at end of file
+# Delete the cached JSON for a tree in every format, called when a tree is uploaded or deleted.
+def invalidate_cache(tree):
+    for format in FORMATS:
+        for path in (cache_path(tree, format), gzip_cache_path(tree, format)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+# Get the path to the cached JSON for a tree in the given format, or None if it has not been built yet
+# (e.g. trees that were uploaded before the cache existed, or formats which haven't been asked for yet).
+def get_cache(tree, format="json"):
+    path = cache_path(tree, format)
+    if os.path.isfile(path):
+        return path
+    return None
+
+# Stream the JSON for a tree whose cache has not been built, building the cache as it goes.
+# Returns None if the tree does not exist.
+def stream_cache(tree, format="json"):
+    db = get_tree_db(tree)
+    if db is None:
+        return None
+    return write_cache(db, tree, format)
@@ -0,0 +1,124 @@
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import MultipartParseError
+import hashlib
+import os
+
+# Reads files uploaded in a multipart/form-data request as the body arrives,
+# instead of letting Starlette spool the whole body to a temporary file first and then copying it.
+# Each chunk of the file is written straight to where it is saved, and hashed as it goes,
+# so the file is only written once and the hash doesn't need another pass over it.
+
+# Raised when the uploaded file is bigger than the maximum size. Whatever had been saved of it is deleted.
+class UploadTooLarge(Exception):
+    pass
+
+# Raised when the request body isn't valid multipart/form-data.
+class UploadMalformed(Exception):
+    pass
+
+# Receives the file in one field of a multipart form, using the parser's callbacks.
+# When the file's headers have been read, open_file is called with its filename, and returns the path to save it to.
+# open_file can raise an exception (e.g. HTTPException) to reject the upload before any of it is saved.
+class FileReceiver:
+    def __init__(self, field_name, max_size, open_file):
+        self.field_name = field_name
+        self.max_size = max_size
+        self.open_file = open_file
+        # The headers of the part being read, and whether it is the file being saved.
+        self.headers = {}
+        self.header_field = b''
+        self.header_value = b''
+        self.receiving = False
+        # The file being saved, set once the file's part starts, and its path, size and hash.
+        self.file = None
+        self.path = None
+        self.filename = None
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def on_part_begin(self):
+        self.headers = {}
+
+    def on_header_field(self, data, start, end):
+        self.header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self.header_value += data[start:end]
+
+    def on_header_end(self):
+        self.headers[self.header_field.lower()] = self.header_value
+        self.header_field = b''
+        self.header_value = b''
+
+    # Only the first part with the right field name and a filename is saved, any other fields are ignored.
+    def on_headers_finished(self):
+        disposition, options = parse_options_header(self.headers.get(b'content-disposition', b''))
+        if self.file is not None or options.get(b'name') != self.field_name.encode() or b'filename' not in options:
+            return
+        self.filename = options[b'filename'].decode('utf-8', 'replace')
+        self.path = self.open_file(self.filename)
+        self.file = open(self.path, 'wb')
+        self.receiving = True
+
+    def on_part_data(self, data, start, end):
+        if not self.receiving:
+            return
+        chunk = data[start:end]
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise UploadTooLarge(f"The file is bigger than the maximum upload size of {self.max_size} bytes")
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def on_part_end(self):
+        self.receiving = False
+
+    # Close the file, and delete it if it wasn't received completely.
+    def close(self, completed):
+        if self.file is None:
+            return
+        self.file.close()
+        if not completed and os.path.exists(self.path):
+            os.remove(self.path)
+
+# Stream the body of a multipart/form-data request, saving the file in field_name to the path returned by open_file(filename).
+# Returns a dictionary of the file's filename, path, size and SHA-256 hash, or None if the request has no file in that field.
+# Raises UploadTooLarge if the file is bigger than max_size bytes, or UploadMalformed if the body can't be parsed,
+# and deletes the part of the file that was saved if anything goes wrong, including the client disconnecting.
+async def receive_file(request, field_name, max_size, open_file):
+    content_type, options = parse_options_header(request.headers.get('content-type', ''))
+    if content_type != b'multipart/form-data' or b'boundary' not in options:
+        raise UploadMalformed("The request must be multipart/form-data")
+
+    receiver = FileReceiver(field_name, max_size, open_file)
+    callbacks = {
+        'on_part_begin': receiver.on_part_begin,
+        'on_header_field': receiver.on_header_field,
+        'on_header_value': receiver.on_header_value,
+        'on_header_end': receiver.on_header_end,
+        'on_headers_finished': receiver.on_headers_finished,
+        'on_part_data': receiver.on_part_data,
+        'on_part_end': receiver.on_part_end,
+    }
+    parser = MultipartParser(options[b'boundary'], callbacks)
+    completed = False
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+        parser.finalize()
+        if receiver.receiving:
+            raise UploadMalformed("The request body ended before the end of the file")
+        completed = True
+    except MultipartParseError as e:
+        raise UploadMalformed(f"The request body could not be read: {e}")
+    finally:
+        receiver.close(completed)
+
+    if receiver.file is None:
+        return None
+    return {
+        "filename": receiver.filename,
+        "path": receiver.path,
+        "size": receiver.size,
+        "sha256": receiver.sha256.hexdigest(),
+    }